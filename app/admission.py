@@ -0,0 +1,143 @@
+# Admission control and load shedding
+#
+# Requests are grouped into route classes and each class gets its own
+# concurrency limit and bounded wait queue, so a burst of full-table reads or
+# heavy GraphQL queries cannot starve cheap point lookups. When a class's
+# queue is full, or a request waited longer than ADMISSION_QUEUE_TIMEOUT
+# seconds, the request is rejected with 503 and a Retry-After header.
+#
+# Limits are set with ADMISSION_<CLASS>_CONCURRENCY and ADMISSION_<CLASS>_QUEUE,
+# for example ADMISSION_LIST_CONCURRENCY=2. Current queue depths and counters
+# are served at GET /admission/metrics.
+import asyncio
+import os
+import re
+from fastapi import APIRouter
+from starlette.responses import JSONResponse
+
+# Route class: (default concurrency, default queue size)
+ROUTE_CLASS_DEFAULTS = {
+    "point_read": (32, 256),
+    "list": (4, 16),
+    "write": (16, 128),
+    "graphql": (8, 32),
+}
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "10"))
+ADMISSION_RETRY_AFTER = os.environ.get("ADMISSION_RETRY_AFTER", "1")
+
+UUID_PATTERN = "[0-9a-fA-F-]{32,36}"
+POINT_READ_PATHS = re.compile(rf"^/inventory(/api)?/{UUID_PATTERN}(/edit)?$")
+LIST_PATHS = re.compile(r"^/inventory(/api/|/api/search|/api/count|/add)?$")
+WRITE_PATHS = re.compile(r"^/inventory(/|$)")
+
+
+# Map a request to its route class, None means it is not limited
+# (static files, docs, metrics)
+def classify(method: str, path: str) -> str | None:
+    if path.startswith("/graphql"):
+        return "graphql"
+    if method in ("POST", "PATCH", "PUT", "DELETE"):
+        return "write" if WRITE_PATHS.match(path) else None
+    if POINT_READ_PATHS.match(path):
+        return "point_read"
+    if LIST_PATHS.match(path):
+        return "list"
+    return None
+
+
+class RouteClassLimiter:
+    def __init__(self, name, concurrency, queue_size, queue_timeout):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.active = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.admitted = 0
+        self.shed = 0
+
+    # Wait for a free slot, returns False if the request should be shed
+    async def acquire(self) -> bool:
+        if not self.semaphore.locked():
+            await self.semaphore.acquire()
+        elif self.queued >= self.queue_size:
+            self.shed += 1
+            return False
+        else:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.shed += 1
+                return False
+            finally:
+                self.queued -= 1
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self.semaphore.release()
+
+    def metrics(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "queue_size": self.queue_size,
+            "active": self.active,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "admitted": self.admitted,
+            "shed": self.shed,
+        }
+
+
+limiters = {
+    name: RouteClassLimiter(
+        name,
+        int(os.environ.get(f"ADMISSION_{name.upper()}_CONCURRENCY", concurrency)),
+        int(os.environ.get(f"ADMISSION_{name.upper()}_QUEUE", queue_size)),
+        ADMISSION_QUEUE_TIMEOUT,
+    )
+    for name, (concurrency, queue_size) in ROUTE_CLASS_DEFAULTS.items()
+}
+
+
+class AdmissionControlMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route_class = classify(scope["method"], scope["path"])
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        limiter = limiters[route_class]
+        if not await limiter.acquire():
+            response = JSONResponse(
+                {"detail": "Server is busy, retry later"},
+                status_code=503,
+                headers={"Retry-After": ADMISSION_RETRY_AFTER},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
+
+
+admission_api = APIRouter()
+
+
+@admission_api.get("/admission/metrics", include_in_schema=False)
+def admission_metrics():
+    return {name: limiter.metrics() for name, limiter in limiters.items()}
@@ -0,0 +1,91 @@
+# Admission control
+#
+# Runs the middleware on a small app whose list route blocks until released:
+# once the list class's slots and queue are full, further list requests are
+# shed with 503 and Retry-After while point reads are still served.
+#
+# pytest admission_test.py
+import asyncio
+import uuid
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+import admission
+from admission import AdmissionControlMiddleware, RouteClassLimiter
+
+
+def blocking_app(release: asyncio.Event):
+    async def list_items(request):
+        await release.wait()
+        return JSONResponse([])
+
+    async def get_item(request):
+        return JSONResponse({"id": request.path_params["item_id"]})
+
+    app = Starlette(
+        routes=[
+            Route("/inventory/api/", list_items),
+            Route("/inventory/api/{item_id}", get_item),
+        ]
+    )
+    app.add_middleware(AdmissionControlMiddleware)
+    return app
+
+
+# Wait until the limiter has this many requests running and queued
+async def wait_for(limiter, active, queued):
+    while (limiter.active, limiter.queued) != (active, queued):
+        await asyncio.sleep(0.001)
+
+
+def test_full_queue_sheds_lists_but_not_point_reads(monkeypatch):
+    limiter = RouteClassLimiter("list", 1, 1, queue_timeout=10)
+    monkeypatch.setitem(admission.limiters, "list", limiter)
+
+    async def run():
+        release = asyncio.Event()
+        transport = httpx.ASGITransport(app=blocking_app(release))
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            running = asyncio.create_task(client.get("/inventory/api/"))
+            await wait_for(limiter, 1, 0)
+            queued = asyncio.create_task(client.get("/inventory/api/"))
+            await wait_for(limiter, 1, 1)
+
+            shed = await client.get("/inventory/api/")
+            assert shed.status_code == 503
+            assert shed.headers["Retry-After"] == admission.ADMISSION_RETRY_AFTER
+
+            point_read = await client.get(f"/inventory/api/{uuid.uuid4()}")
+            assert point_read.status_code == 200
+
+            release.set()
+            assert (await running).status_code == 200
+            assert (await queued).status_code == 200
+        assert limiter.shed == 1
+        assert limiter.admitted == 2
+
+    asyncio.run(run())
+
+
+def test_queue_timeout_sheds(monkeypatch):
+    limiter = RouteClassLimiter("list", 1, 1, queue_timeout=0.05)
+    monkeypatch.setitem(admission.limiters, "list", limiter)
+
+    async def run():
+        release = asyncio.Event()
+        transport = httpx.ASGITransport(app=blocking_app(release))
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://test"
+        ) as client:
+            running = asyncio.create_task(client.get("/inventory/api/"))
+            await wait_for(limiter, 1, 0)
+            timed_out = await client.get("/inventory/api/")
+            assert timed_out.status_code == 503
+            assert "Retry-After" in timed_out.headers
+            release.set()
+            assert (await running).status_code == 200
+
+    asyncio.run(run())
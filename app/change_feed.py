@@ -0,0 +1,232 @@
+# In-process change feed
+#
+# The write functions in inventory_crud record what they changed on the
+# session, and the changes are broadcast once the transaction commits (so a
+# group commit by the write coalescer publishes all of its writes, and
+# nothing if the commit fails). Clients
+# subscribe through the SSE endpoints (/inventory/api/events and
+# /inventory/events) or the GraphQL inventoryChanges subscription instead of
+# polling the list endpoints.
+import asyncio
+import signal
+import threading
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from sqlalchemy import event
+from sqlmodel import Session
+import models
+
+# A subscriber that falls this many changes behind is sent RESYNC and its
+# subscription ends, the client reloads the items and subscribes again
+CHANGE_QUEUE_SIZE = 1000
+# Comment line sent on idle SSE streams so proxies keep the connection open
+SSE_KEEPALIVE_SECONDS = 15
+# Queued instead of a change when the server shuts down, the subscription ends
+CLOSED = "closed"
+# Queued instead of a change when the subscriber missed changes, the
+# subscription ends
+RESYNC = "resync"
+
+
+@dataclass
+class Change:
+    op: str  # created, updated or deleted
+    item: models.InventoryItems
+    # The item before an update
+    previous: models.InventoryItems | None = None
+
+
+class Subscriber:
+    def __init__(self, filters):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(CHANGE_QUEUE_SIZE)
+        # Only changes to items that have (or had, before an update) these
+        # field values are delivered
+        self.filters = {
+            field: value for field, value in filters.items() if value is not None
+        }
+        self.ended = False
+
+    def matches_item(self, item: models.InventoryItems) -> bool:
+        return all(
+            getattr(item, field) == value for field, value in self.filters.items()
+        )
+
+    # An update that takes an item out of the filter is delivered as well, so
+    # a client that shows the filtered items sees it leave
+    def matches(self, change: Change) -> bool:
+        return self.matches_item(change.item) or (
+            change.previous is not None and self.matches_item(change.previous)
+        )
+
+    def deliver(self, change: Change):
+        if self.ended:
+            return
+        try:
+            self.queue.put_nowait(change)
+        except asyncio.QueueFull:
+            # What it shows is out of date from now on
+            self.end(RESYNC)
+
+    # Replace whatever is still queued with a final marker, nothing is
+    # delivered after it
+    def end(self, marker: str):
+        if self.ended:
+            return
+        self.ended = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(marker)
+
+
+class ChangeBroadcaster:
+    def __init__(self):
+        self.subscribers = set()
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    # listener(change) is called in the committing thread before the write
+    # returns (the read replica uses it to stay current)
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # Safe to call from any thread, writes run in the threadpool and in the
+    # write coalescer thread as well as on the event loop
+    def publish(self, change: Change):
+        for listener in self.listeners:
+            listener(change)
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            if subscriber.matches(change):
+                subscriber.loop.call_soon_threadsafe(subscriber.deliver, change)
+
+    # True while a subscriber only wants changes to items with certain field
+    # values, the write paths then also record the values an item had before
+    # an update (Change.previous)
+    def has_filtered_subscribers(self) -> bool:
+        with self.lock:
+            return any(subscriber.filters for subscriber in self.subscribers)
+
+    # End every subscription, safe to call from any thread
+    def close(self):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.loop.call_soon_threadsafe(subscriber.end, CLOSED)
+
+    @asynccontextmanager
+    async def subscribe(self, **filters):
+        subscriber = Subscriber(filters)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        try:
+            yield subscriber.queue
+        finally:
+            with self.lock:
+                self.subscribers.discard(subscriber)
+
+
+broadcaster = ChangeBroadcaster()
+
+
+# Called by the write functions, the change is published after the commit
+def record_change(
+    session: Session,
+    op: str,
+    item: models.InventoryItems,
+    previous: models.InventoryItems | None = None,
+):
+    session.info.setdefault("inventory_changes", []).append(Change(op, item, previous))
+
+
+# Each SAVEPOINT remembers how many changes had been recorded when it began,
+# so rolling it back (one failed write of a coalesced batch) only drops the
+# changes recorded inside it
+@event.listens_for(Session, "after_transaction_create")
+def mark_savepoint(session, transaction):
+    if transaction.nested:
+        session.info.setdefault("change_savepoints", {})[transaction] = len(
+            session.info.get("inventory_changes", [])
+        )
+
+
+@event.listens_for(Session, "after_transaction_end")
+def forget_savepoint(session, transaction):
+    session.info.get("change_savepoints", {}).pop(transaction, None)
+
+
+@event.listens_for(Session, "after_commit")
+def publish_changes(session):
+    # Also called when a SAVEPOINT is released, only publish on the real commit
+    if session.in_nested_transaction():
+        return
+    for change in session.info.pop("inventory_changes", []):
+        broadcaster.publish(change)
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_changes(session):
+    savepoint = session.get_nested_transaction()
+    if savepoint is None:
+        session.info.pop("inventory_changes", None)
+        return
+    recorded = session.info.get("change_savepoints", {}).get(savepoint)
+    if recorded is not None:
+        del session.info.get("inventory_changes", [])[recorded:]
+
+
+# Wraps the app's lifetime (main.lifespan) and ends the open subscriptions
+# when the server stops. Servers wait for open responses to finish before they
+# shut the app down, which an event stream never does, so the streams are
+# ended as soon as the server gets SIGINT or SIGTERM, and when the app shuts
+# down at the latest.
+@asynccontextmanager
+async def subscriptions_closed_on_shutdown():
+    loop = asyncio.get_running_loop()
+    previous_handlers = {}
+    # Signal handlers can only be set from the main thread, the test client
+    # runs the app in another one
+    if threading.current_thread() is threading.main_thread():
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            previous = signal.getsignal(signal_number)
+            if not callable(previous):
+                continue
+
+            def handler(signal_number, frame, previous=previous):
+                loop.call_soon_threadsafe(broadcaster.close)
+                previous(signal_number, frame)
+
+            previous_handlers[signal_number] = previous
+            signal.signal(signal_number, handler)
+    try:
+        yield
+    finally:
+        for signal_number, previous in previous_handlers.items():
+            signal.signal(signal_number, previous)
+        broadcaster.close()
+
+
+def sse_message(event_name: str, data: str) -> str:
+    lines = "".join(f"data: {line}\n" for line in data.splitlines() or [""])
+    return f"event: {event_name}\n{lines}\n"
+
+
+# Server-Sent Events stream of changes, render(change) returns the data sent
+# for each change and the event name is the change's op. A client that fell
+# too far behind gets a resync event and the stream ends, it has to reload
+# the items (EventSource reconnects by itself).
+async def sse_stream(render, **filters):
+    async with broadcaster.subscribe(**filters) as queue:
+        while True:
+            try:
+                change = await asyncio.wait_for(queue.get(), SSE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if change is CLOSED:
+                return
+            if change is RESYNC:
+                yield sse_message(RESYNC, "{}")
+                return
+            yield sse_message(change.op, render(change))
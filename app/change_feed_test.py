@@ -0,0 +1,198 @@
+# Change feed
+#
+# Updates stay a single UPDATE ... RETURNING while nobody filters the feed,
+# a subscriber filtered on a field still sees an item leave its filter, a
+# subscriber that falls behind is told to reload, and open streams end when
+# the server stops.
+#
+# pytest change_feed_test.py
+# python change_feed_test.py <scenario>   runs one scenario in this process
+import asyncio
+from contextlib import contextmanager
+from scenarios import new_item, run_from_command_line, run_scenario
+
+
+# SQL statements the app sends to the database while the block runs
+@contextmanager
+def sent_statements():
+    from sqlalchemy import event
+    import partitions
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split()[0].upper())
+
+    event.listen(partitions.engines[0], "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(partitions.engines[0], "before_cursor_execute", record)
+
+
+# Without filtered subscribers an update and a poller state change are one
+# statement each, with one filtered subscriber the rows are read first
+def update_reads_only_for_filtered_subscribers():
+    import partitions
+    from change_feed import broadcaster
+    from inventory_crud import (
+        create_inventory,
+        run_write,
+        set_inventory_state,
+        update_inventory,
+    )
+
+    partitions.create_db_and_tables()
+    item = run_write(create_inventory, new_item("a"))
+    with sent_statements() as statements:
+        run_write(update_inventory, item.id, {"state": "OFFLINE"})
+        run_write(set_inventory_state, [item.id], "ONLINE")
+    assert statements == ["UPDATE", "UPDATE"]
+
+    async def with_filtered_subscriber():
+        async with broadcaster.subscribe(location="Site 1"):
+            with sent_statements() as statements:
+                await asyncio.to_thread(
+                    run_write, update_inventory, item.id, {"state": "OFFLINE"}
+                )
+        return statements
+
+    assert asyncio.run(with_filtered_subscriber()) == ["BEGIN", "SELECT", "UPDATE"]
+
+
+# An update that moves an item out of a subscriber's filter is delivered, with
+# the item's new values
+def filtered_subscriber_sees_item_leave():
+    import partitions
+    from change_feed import broadcaster
+    from inventory_crud import (
+        create_inventory,
+        run_write,
+        set_inventory_state,
+        update_inventory,
+    )
+
+    partitions.create_db_and_tables()
+    item = run_write(create_inventory, new_item("a", "Site 1"))
+    run_write(set_inventory_state, [item.id], "ONLINE")
+
+    async def changes_seen(write, *args, **filters):
+        async with broadcaster.subscribe(**filters) as queue:
+            await asyncio.to_thread(run_write, write, *args)
+            return await asyncio.wait_for(queue.get(), 5)
+
+    moved = asyncio.run(
+        changes_seen(
+            update_inventory, item.id, {"location": "Site 2"}, location="Site 1"
+        )
+    )
+    assert (moved.op, moved.item.location) == ("updated", "Site 2")
+    offline = asyncio.run(
+        changes_seen(set_inventory_state, [item.id], "OFFLINE", state="ONLINE")
+    )
+    assert (offline.op, offline.item.state) == ("updated", "OFFLINE")
+
+
+# Open streams end when the server is asked to stop, before it waits for
+# them to finish, and the server's own signal handler still runs
+def streams_end_on_shutdown():
+    import signal
+    from change_feed import sse_stream, subscriptions_closed_on_shutdown
+
+    received = []
+
+    def server_handler(signal_number, frame):
+        received.append(signal_number)
+
+    signal.signal(signal.SIGTERM, server_handler)
+
+    async def next_message(stream):
+        try:
+            return await anext(stream)
+        except StopAsyncIteration:
+            return None
+
+    async def run():
+        async with subscriptions_closed_on_shutdown():
+            stream = asyncio.create_task(next_message(sse_stream(str)))
+            await asyncio.sleep(0.01)
+            signal.raise_signal(signal.SIGTERM)
+            assert await asyncio.wait_for(stream, 5) is None
+            assert received == [signal.SIGTERM]
+            stream = asyncio.create_task(next_message(sse_stream(str)))
+            await asyncio.sleep(0.01)
+        # The app shutting down ends the streams as well
+        assert await asyncio.wait_for(stream, 5) is None
+
+    asyncio.run(run())
+    assert signal.getsignal(signal.SIGTERM) is server_handler
+
+
+# A subscriber that falls behind is told to reload instead of silently
+# missing changes, on SSE and on the GraphQL subscription
+def overflowing_subscriber_is_told_to_resync():
+    import uuid
+    import change_feed
+    import models
+    from change_feed import Change, broadcaster, sse_stream
+    from graphql_schema import schema
+
+    change_feed.CHANGE_QUEUE_SIZE = 3
+
+    def publish_changes(count):
+        for i in range(count):
+            item = models.InventoryItems(
+                **new_item(f"item-{i}"), id=uuid.uuid4(), version=1
+            )
+            broadcaster.publish(Change("created", item))
+
+    async def sse_messages():
+        stream = sse_stream(lambda change: change.item.name)
+        first = asyncio.create_task(anext(stream))
+        await asyncio.sleep(0.01)
+        publish_changes(5)
+        return [await first] + [message async for message in stream]
+
+    async def graphql_results():
+        results = await schema.subscribe("subscription { inventoryChanges { op } }")
+        first = asyncio.create_task(anext(results))
+        await asyncio.sleep(0.01)
+        publish_changes(5)
+        return [await first] + [result async for result in results]
+
+    messages = asyncio.run(asyncio.wait_for(sse_messages(), 5))
+    assert messages == ["event: resync\ndata: {}\n\n"]
+    [result] = asyncio.run(asyncio.wait_for(graphql_results(), 5))
+    assert [error.extensions["code"] for error in result.errors] == ["CHANGES_MISSED"]
+
+
+SCENARIOS = {
+    "update_reads_only_for_filtered_subscribers": (
+        update_reads_only_for_filtered_subscribers
+    ),
+    "filtered_subscriber_sees_item_leave": filtered_subscriber_sees_item_leave,
+    "streams_end_on_shutdown": streams_end_on_shutdown,
+    "overflowing_subscriber_is_told_to_resync": (
+        overflowing_subscriber_is_told_to_resync
+    ),
+}
+
+
+def test_update_reads_only_for_filtered_subscribers():
+    run_scenario(__file__, "update_reads_only_for_filtered_subscribers")
+
+
+def test_filtered_subscriber_sees_item_leave():
+    run_scenario(__file__, "filtered_subscriber_sees_item_leave")
+
+
+def test_streams_end_on_shutdown():
+    run_scenario(__file__, "streams_end_on_shutdown")
+
+
+def test_overflowing_subscriber_is_told_to_resync():
+    run_scenario(__file__, "overflowing_subscriber_is_told_to_resync")
+
+
+if __name__ == "__main__":
+    run_from_command_line(SCENARIOS)
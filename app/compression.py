@@ -0,0 +1,141 @@
+# Response compression
+#
+# Uses brotli when the client prefers it (or accepts it as much as gzip) and
+# the brotli package is installed, otherwise gzip, going by the q-values of
+# Accept-Encoding. Responses smaller than COMPRESSION_MINIMUM_SIZE bytes,
+# text/event-stream responses and responses that already have a
+# Content-Encoding are sent uncompressed.
+#
+# The responder is plain ASGI, it does not depend on the internals of
+# Starlette's GZipMiddleware.
+#
+# brotli is optional, pip install brotli to enable it
+import os
+import zlib
+from starlette.datastructures import Headers, MutableHeaders
+from wire_formats import quality_values
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSION_MINIMUM_SIZE = int(os.environ.get("COMPRESSION_MINIMUM_SIZE", "1000"))
+# Streams would be held back until enough data arrives to compress it
+UNCOMPRESSED_CONTENT_TYPES = ("text/event-stream",)
+
+
+class GzipCompressor:
+    def __init__(self, level=6):
+        # wbits 16 + 15 writes the gzip header and trailer
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    # Compressed data for body, flushed so the client can decode it right away
+    # when more_body is set, the end of the stream otherwise
+    def compress(self, body: bytes, more_body: bool) -> bytes:
+        compressed = self.compressor.compress(body)
+        if more_body:
+            return compressed + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        return compressed + self.compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+    def __init__(self, quality=4):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, body: bytes, more_body: bool) -> bytes:
+        compressed = self.compressor.process(body)
+        if more_body:
+            return compressed + self.compressor.flush()
+        return compressed + self.compressor.finish()
+
+
+# Content-Encoding to use for an Accept-Encoding header, None for identity
+def choose_encoding(accept_encoding: str) -> str | None:
+    accepted = quality_values(accept_encoding)
+    wildcard = accepted.get("*", 0)
+    # In order of preference when the client accepts both equally
+    supported = (["br"] if brotli is not None else []) + ["gzip"]
+    quality = {encoding: accepted.get(encoding, wildcard) for encoding in supported}
+    encoding = max(supported, key=quality.get)
+    return encoding if quality[encoding] > 0 else None
+
+
+class CompressionResponder:
+    def __init__(self, app, encoding, compressor, minimum_size):
+        self.app = app
+        self.encoding = encoding
+        self.compressor = compressor
+        self.minimum_size = minimum_size
+        self.send = None
+        # Held back until the first body message shows whether to compress
+        self.start_message = None
+        self.compressing = False
+
+    async def __call__(self, scope, receive, send):
+        self.send = send
+        await self.app(scope, receive, self.send_with_compression)
+
+    def should_compress(self, headers: Headers, message) -> bool:
+        if "content-encoding" in headers:
+            return False
+        if headers.get("content-type", "").startswith(UNCOMPRESSED_CONTENT_TYPES):
+            return False
+        return message.get("more_body", False) or (
+            len(message.get("body", b"")) >= self.minimum_size
+        )
+
+    def compressed(self, message):
+        body = self.compressor.compress(
+            message.get("body", b""), message.get("more_body", False)
+        )
+        return {**message, "body": body}
+
+    async def send_with_compression(self, message):
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            return
+
+        if self.start_message is not None:
+            start, self.start_message = self.start_message, None
+            headers = MutableHeaders(raw=start["headers"])
+            is_body = message["type"] == "http.response.body"
+            self.compressing = is_body and self.should_compress(headers, message)
+            if self.compressing:
+                message = self.compressed(message)
+                headers["Content-Encoding"] = self.encoding
+                headers.add_vary_header("Accept-Encoding")
+                if message.get("more_body", False):
+                    del headers["Content-Length"]
+                else:
+                    headers["Content-Length"] = str(len(message["body"]))
+            await self.send(start)
+        elif self.compressing and message["type"] == "http.response.body":
+            message = self.compressed(message)
+        await self.send(message)
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=COMPRESSION_MINIMUM_SIZE, compresslevel=6):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("Accept-Encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        compressor = (
+            BrotliCompressor()
+            if encoding == "br"
+            else GzipCompressor(self.compresslevel)
+        )
+        responder = CompressionResponder(
+            self.app, encoding, compressor, self.minimum_size
+        )
+        await responder(scope, receive, send)
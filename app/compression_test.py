@@ -0,0 +1,97 @@
+# Response compression
+#
+# The middleware runs on a small Starlette app here: brotli and gzip bodies
+# must decode to the original, Accept-Encoding q-values pick the encoding,
+# and small bodies and event streams are sent as they are.
+#
+# pytest compression_test.py
+import gzip
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+import compression
+from compression import CompressionMiddleware, choose_encoding
+
+needs_brotli = pytest.mark.skipif(
+    compression.brotli is None, reason="brotli is not installed"
+)
+
+BODY = "inventory " * 500
+
+
+async def chunks():
+    for _ in range(3):
+        yield BODY
+
+
+app = Starlette(
+    routes=[
+        Route("/large", lambda request: PlainTextResponse(BODY)),
+        Route("/small", lambda request: PlainTextResponse("ok")),
+        Route("/stream", lambda request: StreamingResponse(chunks())),
+        Route(
+            "/events",
+            lambda request: StreamingResponse(chunks(), media_type="text/event-stream"),
+        ),
+    ]
+)
+app.add_middleware(CompressionMiddleware)
+client = TestClient(app)
+
+
+@needs_brotli
+def test_choose_encoding():
+    assert choose_encoding("br") == "br"
+    assert choose_encoding("gzip, br") == "br"
+    assert choose_encoding("br;q=0.5, gzip") == "gzip"
+    assert choose_encoding("br;q=0, gzip") == "gzip"
+    assert choose_encoding("br;q=0, gzip;q=0") is None
+    assert choose_encoding("*") == "br"
+    assert choose_encoding("*;q=0") is None
+    assert choose_encoding("identity") is None
+    assert choose_encoding("") is None
+
+
+@needs_brotli
+def test_brotli_response():
+    response = client.get("/large", headers={"Accept-Encoding": "br"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "br"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.text == BODY
+
+
+def test_gzip_when_brotli_refused():
+    response = client.get("/large", headers={"Accept-Encoding": "br;q=0, gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.text == BODY
+
+
+def test_identity_when_nothing_accepted():
+    response = client.get("/large", headers={"Accept-Encoding": "gzip;q=0"})
+    assert "Content-Encoding" not in response.headers
+    assert response.text == BODY
+
+
+def test_compressed_length():
+    with client.stream("GET", "/large", headers={"Accept-Encoding": "gzip"}) as r:
+        body = b"".join(r.iter_raw())
+    assert int(r.headers["Content-Length"]) == len(body)
+    assert gzip.decompress(body).decode() == BODY
+
+
+@needs_brotli
+def test_streamed_response():
+    with client.stream("GET", "/stream", headers={"Accept-Encoding": "br"}) as r:
+        body = b"".join(r.iter_raw())
+    assert r.headers["Content-Encoding"] == "br"
+    assert "Content-Length" not in r.headers
+    assert compression.brotli.decompress(body).decode() == BODY * 3
+
+
+def test_small_and_event_stream_bodies_uncompressed():
+    for path in ["/small", "/events"]:
+        response = client.get(path, headers={"Accept-Encoding": "br, gzip"})
+        assert "Content-Encoding" not in response.headers
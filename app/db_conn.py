@@ -1,10 +1,15 @@
 import os
+import uuid
+from sqlalchemy import LargeBinary, MetaData, Table, inspect, insert, text
 from sqlmodel import Field, Session, SQLModel, create_engine, select
 from fastapi import FastAPI, Depends
+import models
 
 # setup database connection
 sqlite_file_name = os.path.abspath(
-    "/Users/a.newberry/_code/api-app-demo/data/inventory.db"
+    os.environ.get(
+        "INVENTORY_DB", "/Users/a.newberry/_code/api-app-demo/data/inventory.db"
+    )
 )
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
@@ -16,8 +21,64 @@ engine = create_engine(sqlite_url, connect_args=connect_args)
 
 
 # Create the database and tables
-def create_db_and_tables():
+def create_db_and_tables(engine=engine):
     SQLModel.metadata.create_all(engine)
+    upgrade_db(engine)
+
+
+# Add columns and indexes that are missing from databases created by older
+# versions
+# ToDO - replace with Alembic migrations
+def upgrade_db(engine=engine):
+    columns = {
+        column["name"]: column for column in inspect(engine).get_columns("inventory")
+    }
+    with engine.begin() as conn:
+        if "version" not in columns:
+            conn.execute(
+                text(
+                    "ALTER TABLE inventory ADD COLUMN version INTEGER NOT NULL DEFAULT 1"
+                )
+            )
+        for index in SQLModel.metadata.tables["inventory"].indexes:
+            index.create(conn, checkfirst=True)
+    if isinstance(columns["id"]["type"], LargeBinary) != models.COMPACT_IDS:
+        convert_ids(engine)
+
+
+# Rebuild the inventory table with ids stored the way models.COMPACT_IDS says
+# (16 bytes or 32 hex characters), the ids themselves do not change
+def convert_ids(engine, batch_size=5000):
+    table = SQLModel.metadata.tables["inventory"]
+    with engine.connect() as conn:
+        # One transaction for the whole rebuild, the sqlite3 driver would not
+        # start one before the DDL statements
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        # Index names are global in SQLite, the new table reuses them
+        for index in inspect(conn).get_indexes("inventory"):
+            conn.exec_driver_sql(f'DROP INDEX "{index["name"]}"')
+        conn.exec_driver_sql("ALTER TABLE inventory RENAME TO inventory_old")
+        table.create(conn)
+
+        old_table = Table("inventory_old", MetaData(), autoload_with=conn)
+        rows = conn.execute(old_table.select()).mappings()
+        for batch in rows.partitions(batch_size):
+            conn.execute(
+                insert(table),
+                [
+                    {
+                        **row,
+                        "id": (
+                            uuid.UUID(bytes=row["id"])
+                            if isinstance(row["id"], bytes)
+                            else uuid.UUID(row["id"])
+                        ),
+                    }
+                    for row in batch
+                ],
+            )
+        conn.exec_driver_sql("DROP TABLE inventory_old")
+        conn.commit()
 
 
 # Create Session Dependency
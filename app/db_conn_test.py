@@ -0,0 +1,102 @@
+# Id storage conversion
+#
+# Switching INVENTORY_COMPACT_IDS on and off again converts the ids of an
+# existing database from text to 16 bytes and back on startup. The items, their
+# ids and the indexes of the table stay the same.
+#
+# pytest db_conn_test.py
+# python db_conn_test.py <scenario>   runs one scenario in this process
+import json
+import os
+from scenarios import new_item, run_from_command_line, run_scenario
+
+
+# Written next to the database by the first step, checked by the others
+def expected_file():
+    import db_conn
+
+    return os.path.join(os.path.dirname(db_conn.sqlite_file_name), "expected.json")
+
+
+# SQLite storage class of every id, and the table's indexes
+def stored_ids_and_indexes():
+    from sqlalchemy import inspect
+    import db_conn
+
+    with db_conn.engine.connect() as conn:
+        types = set(conn.exec_driver_sql("SELECT typeof(id) FROM inventory").scalars())
+    indexes = sorted(
+        (index["name"], index["column_names"], bool(index["unique"]))
+        for index in inspect(db_conn.engine).get_indexes("inventory")
+    )
+    return types, [list(index) for index in indexes]
+
+
+def items():
+    from inventory_crud import find_inventory
+
+    return sorted(
+        (item.model_dump(mode="json") for item in find_inventory()),
+        key=lambda item: item["id"],
+    )
+
+
+def text_ids_stored():
+    import db_conn
+    from inventory_crud import create_inventory, run_write
+
+    db_conn.create_db_and_tables()
+    for i in range(5):
+        run_write(create_inventory, new_item(f"item-{i}", f"Site {i % 2}"))
+    types, indexes = stored_ids_and_indexes()
+    assert types == {"text"}
+    with open(expected_file(), "w") as f:
+        json.dump({"items": items(), "indexes": indexes}, f)
+
+
+# Starting with the other id storage converts the ids, every item can still
+# be read by its id
+def ids_converted_to(storage_class):
+    import uuid
+    import db_conn
+    from inventory_crud import get_inventory
+
+    db_conn.create_db_and_tables()
+    with open(expected_file()) as f:
+        expected = json.load(f)
+    types, indexes = stored_ids_and_indexes()
+    assert types == {storage_class}
+    assert indexes == expected["indexes"]
+    assert items() == expected["items"]
+    for item in expected["items"]:
+        assert get_inventory(uuid.UUID(item["id"])).name == item["name"]
+
+
+SCENARIOS = {
+    "text_ids_stored": text_ids_stored,
+    "ids_converted_to_binary": lambda: ids_converted_to("blob"),
+    "ids_converted_to_text": lambda: ids_converted_to("text"),
+}
+
+
+def test_ids_round_trip_text_binary_text(tmp_path):
+    database = str(tmp_path / "inventory.db")
+    run_scenario(
+        __file__, "text_ids_stored", INVENTORY_DB=database, INVENTORY_COMPACT_IDS="0"
+    )
+    run_scenario(
+        __file__,
+        "ids_converted_to_binary",
+        INVENTORY_DB=database,
+        INVENTORY_COMPACT_IDS="1",
+    )
+    run_scenario(
+        __file__,
+        "ids_converted_to_text",
+        INVENTORY_DB=database,
+        INVENTORY_COMPACT_IDS="0",
+    )
+
+
+if __name__ == "__main__":
+    run_from_command_line(SCENARIOS)
@@ -0,0 +1,96 @@
+# Simulated devices for the reachability poller
+#
+# FakeNetwork.probe answers like reachability.tcp_probe but from a simulated
+# network, so the poller can be run and benchmarked offline with any number
+# of devices. Most devices answer after a few milliseconds. offline_ratio of
+# them are down: half refuse the connection, the other half never answer and
+# use up the whole probe timeout. On every probe a device flips between up
+# and down with probability flap_ratio, so each cycle has some transitions.
+#
+# Run the app against it with INVENTORY_POLLER=1 INVENTORY_POLLER_FAKE_DEVICES=1
+#
+# python fake_devices.py [devices] [cycles]
+#   seeds a throwaway database (100000 devices by default) and prints the
+#   metrics of each poll cycle. The poller settings come from the usual
+#   INVENTORY_POLL_* variables, INVENTORY_PARTITIONS and
+#   INVENTORY_WRITE_COALESCING are honoured as well.
+import asyncio
+import random
+import sys
+from sample_inventory import seed_devices, use_throwaway_database
+
+UP = "up"
+REFUSED = "refused"
+SILENT = "silent"
+
+
+class FakeNetwork:
+    def __init__(
+        self, offline_ratio=0.05, flap_ratio=0.01, latency_ms=(0.1, 5.0), seed=None
+    ):
+        self.offline_ratio = offline_ratio
+        self.flap_ratio = flap_ratio
+        self.latency_ms = latency_ms
+        self.rng = random.Random(seed)
+        # host -> UP, REFUSED or SILENT
+        self.devices = {}
+
+    def down_state(self):
+        return self.rng.choice([REFUSED, SILENT])
+
+    def device_state(self, host):
+        state = self.devices.get(host)
+        if state is None:
+            state = self.down_state() if self.rng.random() < self.offline_ratio else UP
+        elif self.rng.random() < self.flap_ratio:
+            state = self.down_state() if state == UP else UP
+        self.devices[host] = state
+        return state
+
+    async def probe(self, host: str, ports: list[int], timeout: float) -> bool:
+        state = self.device_state(host)
+        if state == SILENT:
+            await asyncio.sleep(timeout)
+            return False
+        await asyncio.sleep(min(timeout, self.rng.uniform(*self.latency_ms) / 1000))
+        return state == UP
+
+
+async def benchmark(count: int, cycles: int):
+    import partitions
+    import reachability
+    import write_coalescer
+
+    partitions.create_db_and_tables()
+    # All ONLINE, so the first cycle writes the devices found down
+    seed_devices(count, state="ONLINE")
+    if write_coalescer.WRITE_COALESCING:
+        for coalescer in write_coalescer.coalescers:
+            coalescer.start()
+
+    poller = reachability.ReachabilityPoller(FakeNetwork(seed=0).probe)
+    print(
+        f"{count} devices, concurrency {poller.concurrency}, "
+        f"timeout {poller.timeout}s, batch size {poller.batch_size}"
+    )
+    try:
+        for cycle in range(cycles):
+            metrics = await poller.poll()
+            print(
+                f"cycle {cycle + 1}: {metrics['duration_seconds']}s "
+                f"(load {metrics['load_seconds']}s, probe {metrics['probe_seconds']}s), "
+                f"{metrics['probes_per_second']} probes/s, "
+                f"{metrics['online']} online, {metrics['offline']} offline, "
+                f"{metrics['written']} transitions written in "
+                f"{metrics['write_batches']} batches"
+            )
+    finally:
+        for coalescer in write_coalescer.coalescers:
+            coalescer.stop()
+
+
+if __name__ == "__main__":
+    use_throwaway_database("fake-devices")
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    cycles = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    asyncio.run(benchmark(count, cycles))
@@ -1,15 +1,34 @@
 import strawberry
-from typing import List, Optional
+import hashlib
+from collections import OrderedDict
+from graphql import GraphQLError
+from typing import AsyncGenerator, List, Optional
 import uuid
 from datetime import date
-from sqlmodel import Session, select
-from db_conn import get_session, engine
+from strawberry.fastapi import GraphQLRouter
+from strawberry.http import GraphQLRequestData
+from strawberry.schema.config import StrawberryConfig
+from strawberry.types import ExecutionResult
+from change_feed import CLOSED, RESYNC, broadcaster
+from inventory_crud import (
+    InventoryNotFound,
+    MoveIncomplete,
+    NameAlreadyExists,
+    VersionConflict,
+    create_inventory,
+    delete_inventory,
+    find_inventory,
+    get_inventory,
+    run_write_async,
+    update_inventory,
+)
 import models
 
 
 @strawberry.type
 class InventoryType:
     id: uuid.UUID
+    version: int
     name: Optional[str] = None
     ip_address: Optional[str] = strawberry.field(name="ipAddress")
     location: Optional[str] = None
@@ -37,6 +56,8 @@ class InventoryInput:
 @strawberry.input
 class InventoryUpdateInput:
     id: uuid.UUID
+    # Expected current version, the update fails if the item has changed
+    version: Optional[int] = None
     name: Optional[str] = strawberry.UNSET
     ip_address: Optional[str] = strawberry.field(
         name="ipAddress", default=strawberry.UNSET
@@ -60,117 +81,31 @@ class InventoryUpdateInput:
 class Query:
     @strawberry.field
     def inventory_items(self) -> List[InventoryType]:
-        session = next(get_session())
-        try:
-            inventory_items = session.exec(select(models.Inventory)).all()
-            return [
-                InventoryType(
-                    id=item.id,
-                    name=item.name,
-                    ip_address=item.ip_address,
-                    location=item.location,
-                    state=item.state,
-                    device_type=item.device_type,
-                    make=item.make,
-                    model=item.model,
-                    os_version=item.os_version,
-                    end_of_support=item.end_of_support,
-                )
-                for item in inventory_items
-            ]
-        finally:
-            session.close()
+        inventory_items = find_inventory()
+        return [
+            InventoryType(
+                id=item.id,
+                version=item.version,
+                name=item.name,
+                ip_address=item.ip_address,
+                location=item.location,
+                state=item.state,
+                device_type=item.device_type,
+                make=item.make,
+                model=item.model,
+                os_version=item.os_version,
+                end_of_support=item.end_of_support,
+            )
+            for item in inventory_items
+        ]
 
     @strawberry.field
     def inventory_item(self, id: uuid.UUID) -> Optional[InventoryType]:
-        session = next(get_session())
-        try:
-            inventory = session.get(models.Inventory, id)
-            if inventory:
-                return InventoryType(
-                    id=inventory.id,
-                    name=inventory.name,
-                    ip_address=inventory.ip_address,
-                    location=inventory.location,
-                    state=inventory.state,
-                    device_type=inventory.device_type,
-                    make=inventory.make,
-                    model=inventory.model,
-                    os_version=inventory.os_version,
-                    end_of_support=inventory.end_of_support,
-                )
-            return None
-        finally:
-            session.close()
-
-    @strawberry.field
-    def inventory_by_location(self, location: str) -> List[InventoryType]:
-        session = next(get_session())
-        try:
-            inventory_items = session.exec(
-                select(models.Inventory).where(models.Inventory.location == location)
-            ).all()
-            return [
-                InventoryType(
-                    id=item.id,
-                    name=item.name,
-                    ip_address=item.ip_address,
-                    location=item.location,
-                    state=item.state,
-                    device_type=item.device_type,
-                    make=item.make,
-                    model=item.model,
-                    os_version=item.os_version,
-                    end_of_support=item.end_of_support,
-                )
-                for item in inventory_items
-            ]
-        finally:
-            session.close()
-
-    @strawberry.field
-    def inventory_by_make(self, make: str) -> List[InventoryType]:
-        session = next(get_session())
-        try:
-            inventory_items = session.exec(
-                select(models.Inventory).where(models.Inventory.make == make)
-            ).all()
-            return [
-                InventoryType(
-                    id=item.id,
-                    name=item.name,
-                    ip_address=item.ip_address,
-                    location=item.location,
-                    state=item.state,
-                    device_type=item.device_type,
-                    make=item.make,
-                    model=item.model,
-                    os_version=item.os_version,
-                    end_of_support=item.end_of_support,
-                )
-                for item in inventory_items
-            ]
-        finally:
-            session.close()
-
-
-@strawberry.type
-class Mutation:
-    @strawberry.mutation
-    def create_inventory_item(self, inventory: InventoryInput) -> InventoryType:
-        session = next(get_session())
-        try:
-            # Check if name already exists
-            if inventory.name:
-                existing = session.exec(
-                    select(models.Inventory).where(
-                        models.Inventory.name == inventory.name
-                    )
-                ).first()
-                if existing:
-                    raise Exception(f"Name '{inventory.name}' already exists")
-
-            db_inventory = models.Inventory(
+        inventory = get_inventory(id)
+        if inventory:
+            return InventoryType(
+                id=inventory.id,
+                version=inventory.version,
                 name=inventory.name,
                 ip_address=inventory.ip_address,
                 location=inventory.location,
@@ -181,83 +116,111 @@ class Mutation:
                 os_version=inventory.os_version,
                 end_of_support=inventory.end_of_support,
             )
-            session.add(db_inventory)
-            session.commit()
-            session.refresh(db_inventory)
+        return None
 
-            return InventoryType(
-                id=db_inventory.id,
-                name=db_inventory.name,
-                ip_address=db_inventory.ip_address,
-                location=db_inventory.location,
-                state=db_inventory.state,
-                device_type=db_inventory.device_type,
-                make=db_inventory.make,
-                model=db_inventory.model,
-                os_version=db_inventory.os_version,
-                end_of_support=db_inventory.end_of_support,
+    @strawberry.field
+    def inventory_by_location(self, location: str) -> List[InventoryType]:
+        inventory_items = find_inventory({"location": location})
+        return [
+            InventoryType(
+                id=item.id,
+                version=item.version,
+                name=item.name,
+                ip_address=item.ip_address,
+                location=item.location,
+                state=item.state,
+                device_type=item.device_type,
+                make=item.make,
+                model=item.model,
+                os_version=item.os_version,
+                end_of_support=item.end_of_support,
+            )
+            for item in inventory_items
+        ]
+
+    @strawberry.field
+    def inventory_by_make(self, make: str) -> List[InventoryType]:
+        inventory_items = find_inventory({"make": make})
+        return [
+            InventoryType(
+                id=item.id,
+                version=item.version,
+                name=item.name,
+                ip_address=item.ip_address,
+                location=item.location,
+                state=item.state,
+                device_type=item.device_type,
+                make=item.make,
+                model=item.model,
+                os_version=item.os_version,
+                end_of_support=item.end_of_support,
             )
-        finally:
-            session.close()
+            for item in inventory_items
+        ]
 
 
-@strawberry.mutation
-def update_inventory_item(
-    self, info: strawberry.Info, inventory: InventoryUpdateInput
-) -> Optional[InventoryType]:
-    from sqlalchemy import text
+@strawberry.type
+class Mutation:
+    @strawberry.mutation
+    async def create_inventory_item(self, inventory: InventoryInput) -> InventoryType:
+        try:
+            db_inventory = await run_write_async(
+                create_inventory,
+                {
+                    "name": inventory.name,
+                    "ip_address": inventory.ip_address,
+                    "location": inventory.location,
+                    "state": inventory.state,
+                    "device_type": inventory.device_type,
+                    "make": inventory.make,
+                    "model": inventory.model,
+                    "os_version": inventory.os_version,
+                    "end_of_support": inventory.end_of_support,
+                },
+            )
+        except NameAlreadyExists as e:
+            raise Exception(str(e))
 
-    with Session(engine) as session:
-        # First check if the item exists
-        db_inventory = session.get(models.Inventory, inventory.id)
-        if not db_inventory:
-            raise Exception(f"Inventory item with id {inventory.id} not found")
+        return InventoryType(
+            id=db_inventory.id,
+            version=db_inventory.version,
+            name=db_inventory.name,
+            ip_address=db_inventory.ip_address,
+            location=db_inventory.location,
+            state=db_inventory.state,
+            device_type=db_inventory.device_type,
+            make=db_inventory.make,
+            model=db_inventory.model,
+            os_version=db_inventory.os_version,
+            end_of_support=db_inventory.end_of_support,
+        )
 
+    @strawberry.mutation
+    async def update_inventory_item(
+        self, info: strawberry.Info, inventory: InventoryUpdateInput
+    ) -> Optional[InventoryType]:
         # Build update dictionary with only provided fields
-        update_data = {}
-        if inventory.name is not strawberry.UNSET:
-            update_data["name"] = inventory.name
-        if inventory.ip_address is not strawberry.UNSET:
-            update_data["ip_address"] = inventory.ip_address
-        if inventory.location is not strawberry.UNSET:
-            update_data["location"] = inventory.location
-        if inventory.state is not strawberry.UNSET:
-            update_data["state"] = inventory.state
-        if inventory.device_type is not strawberry.UNSET:
-            update_data["device_type"] = inventory.device_type
-        if inventory.make is not strawberry.UNSET:
-            update_data["make"] = inventory.make
-        if inventory.model is not strawberry.UNSET:
-            update_data["model"] = inventory.model
-        if inventory.os_version is not strawberry.UNSET:
-            update_data["os_version"] = inventory.os_version
-        if inventory.end_of_support is not strawberry.UNSET:
-            update_data["end_of_support"] = inventory.end_of_support
+        update_data = {
+            field_name: getattr(inventory, field_name)
+            for field_name in models.InventoryUpdate.model_fields
+            if field_name != "version"
+            and getattr(inventory, field_name) is not strawberry.UNSET
+        }
 
         # Only proceed if there's something to update
         if not update_data:
             raise Exception("No fields provided for update")
 
-        # Build dynamic SQL update statement
-        set_clauses = []
-        params = {}
-        for field_name, field_value in update_data.items():
-            set_clauses.append(f"{field_name} = :{field_name}")
-            params[field_name] = field_value
-
-        params["item_id"] = str(inventory.id)
-
-        # Execute raw SQL to avoid SQLAlchemy's object tracking issues
-        sql = f"UPDATE inventory SET {', '.join(set_clauses)} WHERE id = :item_id"
-        session.execute(text(sql), params)
-        session.commit()
-
-        # Fetch the updated record
-        updated_inventory = session.get(models.Inventory, inventory.id)
-        session.refresh(updated_inventory)
+        try:
+            updated_inventory = await run_write_async(
+                update_inventory, inventory.id, update_data, inventory.version
+            )
+        except (InventoryNotFound, VersionConflict, MoveIncomplete) as e:
+            raise Exception(str(e))
 
         return InventoryType(
             id=updated_inventory.id,
+            version=updated_inventory.version,
             name=updated_inventory.name,
             ip_address=updated_inventory.ip_address,
             location=updated_inventory.location,
@@ -270,18 +233,143 @@ def update_inventory_item(
         )
 
     @strawberry.mutation
-    def delete_inventory_item(self, id: uuid.UUID) -> bool:
-        session = next(get_session())
+    async def delete_inventory_item(self, id: uuid.UUID) -> bool:
         try:
-            inventory = session.get(models.Inventory, id)
-            if not inventory:
-                raise Exception(f"Inventory item with id {id} not found")
+            await run_write_async(delete_inventory, id)
+        except InventoryNotFound as e:
+            raise Exception(str(e))
+        return True
+
+
+@strawberry.type
+class InventoryChange:
+    op: str
+    item: InventoryType
+
+
+@strawberry.type
+class Subscription:
+    # Changes to items matching every filter given, pushed after each commit.
+    # Updates that take an item out of the filter are pushed as well. A client
+    # that falls too far behind gets a CHANGES_MISSED error and the
+    # subscription ends.
+    @strawberry.subscription
+    async def inventory_changes(
+        self,
+        name: Optional[str] = None,
+        location: Optional[str] = None,
+        state: Optional[str] = None,
+        device_type: Optional[str] = None,
+        make: Optional[str] = None,
+        model: Optional[str] = None,
+    ) -> AsyncGenerator[InventoryChange, None]:
+        async with broadcaster.subscribe(
+            name=name,
+            location=location,
+            state=state,
+            device_type=device_type,
+            make=make,
+            model=model,
+        ) as queue:
+            while True:
+                change = await queue.get()
+                if change is CLOSED:
+                    return
+                if change is RESYNC:
+                    raise GraphQLError(
+                        "Changes were missed, reload the items and subscribe again",
+                        extensions={"code": "CHANGES_MISSED"},
+                    )
+                item = change.item
+                yield InventoryChange(
+                    op=change.op,
+                    item=InventoryType(
+                        id=item.id,
+                        version=item.version,
+                        name=item.name,
+                        ip_address=item.ip_address,
+                        location=item.location,
+                        state=item.state,
+                        device_type=item.device_type,
+                        make=item.make,
+                        model=item.model,
+                        os_version=item.os_version,
+                        end_of_support=item.end_of_support,
+                    ),
+                )
+
+
+# Operation batching lets clients send several operations in one HTTP request
+# (a JSON list instead of a single object)
+MAX_BATCH_OPERATIONS = 100
+
+schema = strawberry.Schema(
+    query=Query,
+    mutation=Mutation,
+    subscription=Subscription,
+    config=StrawberryConfig(batching_config={"max_operations": MAX_BATCH_OPERATIONS}),
+)
+
 
-            session.delete(inventory)
-            session.commit()
-            return True
-        finally:
-            session.close()
+# Persisted queries
+# Clients send {"extensions": {"persistedQuery": {"sha256Hash": ...}}} instead
+# of the full query string. As in Apollo's automatic persisted queries, an
+# unknown hash gets a 200 response with a PERSISTED_QUERY_NOT_FOUND error and
+# the client retries once with query + hash, which registers the query for
+# later requests. In a batch each operation gets its own result, so one
+# unknown hash does not fail the other operations.
+MAX_PERSISTED_QUERIES = 1000
+# Least recently used first, the first one is dropped when the cache is full
+persisted_queries: OrderedDict[str, str] = OrderedDict()
 
 
-schema = strawberry.Schema(query=Query, mutation=Mutation)
+class PersistedQueryError(Exception):
+    def __init__(self, message: str, code: str):
+        super().__init__(message)
+        self.code = code
+
+
+def resolve_persisted_query(request_data: GraphQLRequestData) -> GraphQLRequestData:
+    persisted_query = (request_data.extensions or {}).get("persistedQuery")
+    if not persisted_query:
+        return request_data
+
+    query_hash = persisted_query.get("sha256Hash")
+    if not query_hash:
+        raise PersistedQueryError(
+            "persistedQuery.sha256Hash is required", "BAD_REQUEST"
+        )
+
+    if request_data.query is None:
+        query = persisted_queries.get(query_hash)
+        if query is None:
+            raise PersistedQueryError(
+                "PersistedQueryNotFound", "PERSISTED_QUERY_NOT_FOUND"
+            )
+        persisted_queries.move_to_end(query_hash)
+        request_data.query = query
+        return request_data
+
+    if hashlib.sha256(request_data.query.encode()).hexdigest() != query_hash:
+        raise PersistedQueryError(
+            "provided sha256Hash does not match query", "BAD_REQUEST"
+        )
+    persisted_queries[query_hash] = request_data.query
+    persisted_queries.move_to_end(query_hash)
+    if len(persisted_queries) > MAX_PERSISTED_QUERIES:
+        persisted_queries.popitem(last=False)
+    return request_data
+
+
+class InventoryGraphQLRouter(GraphQLRouter):
+    # Called once per operation, for single requests and for every operation
+    # of a batch
+    async def execute_single(self, request_data: GraphQLRequestData, **kwargs):
+        try:
+            request_data = resolve_persisted_query(request_data)
+        except PersistedQueryError as e:
+            return ExecutionResult(
+                data=None,
+                errors=[GraphQLError(str(e), extensions={"code": e.code})],
+            )
+        return await super().execute_single(request_data=request_data, **kwargs)
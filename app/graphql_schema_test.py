@@ -0,0 +1,101 @@
+# Persisted queries
+#
+# An unknown hash only fails its own operation of a batch, with the
+# PERSISTED_QUERY_NOT_FOUND code clients retry on, and the persisted query
+# cache keeps the queries in use when it is full.
+#
+# pytest graphql_schema_test.py
+# python graphql_schema_test.py <scenario>   runs one scenario in this process
+import hashlib
+from scenarios import run_from_command_line, run_scenario
+
+ITEMS_QUERY = "{ inventoryItems { id } }"
+NAMES_QUERY = "{ inventoryItems { name } }"
+
+
+def persisted(query: str, with_query=False) -> dict:
+    operation = {
+        "extensions": {
+            "persistedQuery": {
+                "version": 1,
+                "sha256Hash": hashlib.sha256(query.encode()).hexdigest(),
+            }
+        }
+    }
+    if with_query:
+        operation["query"] = query
+    return operation
+
+
+# In a batch the unknown hash gets its own error, the other operations run.
+# Sending the query with its hash registers it.
+def unknown_hash_fails_its_operation_only():
+    from fastapi.testclient import TestClient
+    from main import app
+
+    with TestClient(app) as client:
+        response = client.post(
+            "/graphql", json=[persisted(ITEMS_QUERY), {"query": NAMES_QUERY}]
+        )
+        assert response.status_code == 200
+        not_found, names = response.json()
+        assert not_found["data"] is None
+        assert [error["extensions"]["code"] for error in not_found["errors"]] == [
+            "PERSISTED_QUERY_NOT_FOUND"
+        ]
+        assert names == {"data": {"inventoryItems": []}}
+
+        registered = client.post("/graphql", json=persisted(ITEMS_QUERY, True))
+        assert registered.json() == {"data": {"inventoryItems": []}}
+        found = client.post("/graphql", json=persisted(ITEMS_QUERY))
+        assert found.json() == {"data": {"inventoryItems": []}}
+
+
+# A full cache drops the query used longest ago, not the newest one
+def full_cache_drops_least_recently_used():
+    from strawberry.http import GraphQLRequestData
+    import graphql_schema
+
+    graphql_schema.MAX_PERSISTED_QUERIES = 2
+
+    def resolve(operation: dict):
+        return graphql_schema.resolve_persisted_query(
+            GraphQLRequestData(
+                query=operation.get("query"),
+                variables=None,
+                operation_name=None,
+                extensions=operation["extensions"],
+            )
+        )
+
+    queries = ["{ a }", "{ b }", "{ c }"]
+    resolve(persisted(queries[0], True))
+    resolve(persisted(queries[1], True))
+    resolve(persisted(queries[0]))
+    resolve(persisted(queries[2], True))
+    assert resolve(persisted(queries[0])).query == queries[0]
+    assert resolve(persisted(queries[2])).query == queries[2]
+    try:
+        resolve(persisted(queries[1]))
+    except graphql_schema.PersistedQueryError as e:
+        assert e.code == "PERSISTED_QUERY_NOT_FOUND"
+    else:
+        raise AssertionError("the least recently used query was kept")
+
+
+SCENARIOS = {
+    "unknown_hash_fails_its_operation_only": unknown_hash_fails_its_operation_only,
+    "full_cache_drops_least_recently_used": full_cache_drops_least_recently_used,
+}
+
+
+def test_unknown_hash_fails_its_operation_only():
+    run_scenario(__file__, "unknown_hash_fails_its_operation_only")
+
+
+def test_full_cache_drops_least_recently_used():
+    run_scenario(__file__, "full_cache_drops_least_recently_used")
+
+
+if __name__ == "__main__":
+    run_from_command_line(SCENARIOS)
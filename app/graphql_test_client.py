@@ -1,4 +1,7 @@
+import asyncio
+import hashlib
 import requests
+import httpx
 import json
 from datetime import date
 
@@ -6,12 +9,14 @@ from datetime import date
 class GraphQLClient:
     def __init__(self, base_url="http://127.0.0.1:8000"):
         self.graphql_url = f"{base_url}/graphql"
+        # Reuse one keep-alive connection for every request
+        self.session = requests.Session()
 
     def execute_query(self, query, variables=None):
         """Execute a GraphQL query or mutation"""
         payload = {"query": query, "variables": variables or {}}
 
-        response = requests.post(
+        response = self.session.post(
             self.graphql_url, json=payload, headers={"Content-Type": "application/json"}
         )
 
@@ -145,6 +150,249 @@ class GraphQLClient:
         return self.execute_query(mutation, variables)
 
 
+CREATE_INVENTORY_MUTATION = """
+mutation CreateInventoryItem($inventory: InventoryInput!) {
+  createInventoryItem(inventory: $inventory) {
+    id
+    name
+  }
+}
+"""
+
+UPDATE_INVENTORY_MUTATION = """
+mutation UpdateInventoryItem($inventory: InventoryUpdateInput!) {
+  updateInventoryItem(inventory: $inventory) {
+    id
+    name
+    state
+  }
+}
+"""
+
+DELETE_INVENTORY_MUTATION = """
+mutation DeleteInventoryItem($id: UUID!) {
+  deleteInventoryItem(id: $id)
+}
+"""
+
+GET_INVENTORY_ITEM_QUERY = """
+query GetInventoryItem($id: UUID!) {
+  inventoryItem(id: $id) {
+    id
+    name
+    ipAddress
+    location
+    state
+    deviceType
+    make
+    model
+    osVersion
+    endOfSupport
+  }
+}
+"""
+
+
+def chunks(items, size):
+    """Split a list into lists of at most size items"""
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def persisted_query_not_found(result):
+    """True if the server did not know the hash of the operation's query"""
+    return any(
+        (error.get("extensions") or {}).get("code") == "PERSISTED_QUERY_NOT_FOUND"
+        for error in (result or {}).get("errors") or []
+    )
+
+
+def rest_payload(item):
+    """Convert a date end_of_support to the string the REST API expects"""
+    if isinstance(item.get("end_of_support"), date):
+        return {**item, "end_of_support": item["end_of_support"].isoformat()}
+    return item
+
+
+class AsyncGraphQLClient:
+    """Async client for bulk automation.
+
+    Uses a pooled keep-alive httpx session, bounds the number of requests in
+    flight, sends several operations per HTTP request (GraphQL batching) and
+    sends persisted-query hashes instead of full query strings.
+
+    async with AsyncGraphQLClient() as client:
+        await client.bulk_create_inventory(devices)
+    """
+
+    def __init__(
+        self,
+        base_url="http://127.0.0.1:8000",
+        max_connections=20,
+        max_concurrency=10,
+        batch_size=50,
+        persisted_queries=True,
+        timeout=30.0,
+    ):
+        self.base_url = base_url
+        self.graphql_url = f"{base_url}/graphql"
+        self.rest_url = f"{base_url}/inventory/api/"
+        # Must not be larger than the server's MAX_BATCH_OPERATIONS
+        self.batch_size = batch_size
+        self.persisted_queries = persisted_queries
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=timeout,
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.client.aclose()
+
+    def _operation(self, query, variables=None, send_query=True):
+        """Build the JSON payload for a single operation"""
+        operation = {"variables": variables or {}}
+        if send_query or not self.persisted_queries:
+            operation["query"] = query
+        if self.persisted_queries:
+            operation["extensions"] = {
+                "persistedQuery": {
+                    "version": 1,
+                    "sha256Hash": hashlib.sha256(query.encode()).hexdigest(),
+                }
+            }
+        return operation
+
+    async def _request(self, method, url, payload=None):
+        async with self.semaphore:
+            return await self.client.request(method, url, json=payload)
+
+    async def _send(self, operations, send_query):
+        """POST a (query, variables) tuple, or a list of them as one batch"""
+        if isinstance(operations, list):
+            payload = [
+                self._operation(query, variables, send_query)
+                for query, variables in operations
+            ]
+        else:
+            payload = self._operation(*operations, send_query)
+        response = await self._request("POST", self.graphql_url, payload)
+
+        if response.status_code == 200:
+            return response.json()
+        else:
+            print(f"Request failed with status {response.status_code}")
+            print(response.text)
+            return None
+
+    async def _post_graphql(self, operations):
+        """POST to /graphql, re-sending the full query of every operation
+        whose hash the server does not know"""
+        result = await self._send(operations, send_query=False)
+        if not self.persisted_queries or result is None:
+            return result
+        if not isinstance(operations, list):
+            if persisted_query_not_found(result):
+                return await self._send(operations, send_query=True)
+            return result
+
+        # Only the operations that were not run are sent again
+        missing = [i for i, r in enumerate(result) if persisted_query_not_found(r)]
+        if missing:
+            retried = await self._send(
+                [operations[i] for i in missing], send_query=True
+            )
+            for i, retried_result in zip(missing, retried or [None] * len(missing)):
+                result[i] = retried_result
+        return result
+
+    async def execute_query(self, query, variables=None):
+        """Execute a single GraphQL query or mutation"""
+        return await self._post_graphql((query, variables))
+
+    async def execute_batch(self, operations):
+        """Execute a list of (query, variables) tuples in one HTTP request.
+
+        Returns one result per operation, in the same order.
+        """
+        return await self._post_graphql(list(operations))
+
+    async def _bulk(self, operations):
+        """Split operations into batches and send the batches concurrently"""
+        batches = await asyncio.gather(
+            *[
+                self.execute_batch(batch)
+                for batch in chunks(operations, self.batch_size)
+            ]
+        )
+        results = []
+        for batch, batch_results in zip(chunks(operations, self.batch_size), batches):
+            # A failed HTTP request fails every operation in the batch
+            results.extend(batch_results or [None] * len(batch))
+        return results
+
+    async def get_inventory_by_ids(self, item_ids):
+        """Get many inventory items by ID"""
+        return await self._bulk(
+            [(GET_INVENTORY_ITEM_QUERY, {"id": str(item_id)}) for item_id in item_ids]
+        )
+
+    async def bulk_create_inventory(self, items):
+        """Create many inventory items (dicts using the GraphQL field names)"""
+        operations = []
+        for item in items:
+            item = dict(item)
+            if isinstance(item.get("endOfSupport"), date):
+                item["endOfSupport"] = item["endOfSupport"].isoformat()
+            operations.append((CREATE_INVENTORY_MUTATION, {"inventory": item}))
+        return await self._bulk(operations)
+
+    async def bulk_update_inventory(self, updates):
+        """Update many inventory items, each dict must include an id"""
+        operations = []
+        for update in updates:
+            update = dict(update)
+            if isinstance(update.get("endOfSupport"), date):
+                update["endOfSupport"] = update["endOfSupport"].isoformat()
+            update["id"] = str(update["id"])
+            operations.append((UPDATE_INVENTORY_MUTATION, {"inventory": update}))
+        return await self._bulk(operations)
+
+    async def bulk_delete_inventory(self, item_ids):
+        """Delete many inventory items by ID"""
+        return await self._bulk(
+            [(DELETE_INVENTORY_MUTATION, {"id": str(item_id)}) for item_id in item_ids]
+        )
+
+    async def rest_get_all_inventory(self):
+        """Get all inventory items from the REST API"""
+        response = await self._request("GET", self.rest_url)
+        return response.json() if response.status_code == 200 else None
+
+    async def rest_bulk_create_inventory(self, items):
+        """Create many inventory items (dicts using the REST field names)
+        through the REST API, one request per item over the pooled session"""
+        responses = await asyncio.gather(
+            *[
+                self._request("POST", self.rest_url, rest_payload(item))
+                for item in items
+            ]
+        )
+        return [
+            response.json() if response.status_code == 200 else None
+            for response in responses
+        ]
+
+
 def main():
     """Example usage of the GraphQL client"""
     client = GraphQLClient()
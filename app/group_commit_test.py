@@ -0,0 +1,143 @@
+# Failure handling of group commits
+#
+# The write coalescer runs every write of a batch in its own SAVEPOINT and
+# commits the batch at once. These checks make sure that what a batch
+# publishes matches what it actually committed when one of its writes fails or
+# when the commit itself fails, that writes cancelled by their caller are
+# skipped, and that async routes wait for their writes off the event loop.
+#
+# pytest group_commit_test.py
+# python group_commit_test.py <scenario>   runs one scenario in this process
+import time
+from scenarios import (
+    failing_commits,
+    group_commit,
+    new_item,
+    published_changes,
+    run_from_command_line,
+    run_scenario,
+)
+
+
+# One failed write only drops its own changes, the rest of the batch is
+# committed and published
+def failed_write_keeps_batch_changes():
+    import partitions
+    from inventory_crud import NameAlreadyExists, create_inventory
+
+    partitions.create_db_and_tables()
+    with published_changes() as changes:
+        futures = group_commit(
+            0,
+            (create_inventory, new_item("a")),
+            (create_inventory, new_item("a")),
+            (create_inventory, new_item("b")),
+        )
+    assert isinstance(futures[1].exception(), NameAlreadyExists)
+    assert [(change.op, change.item.name) for change in changes] == [
+        ("created", "a"),
+        ("created", "b"),
+    ]
+
+
+# Nothing is published when the group commit fails
+def failed_commit_publishes_nothing():
+    import partitions
+    from inventory_crud import count_inventory, create_inventory
+
+    partitions.create_db_and_tables()
+    with published_changes() as changes, failing_commits():
+        futures = group_commit(0, (create_inventory, new_item("ghost")))
+    assert futures[0].exception() is not None
+    assert changes == []
+    assert count_inventory() == 0
+
+
+# A write its caller cancelled before the batch ran is skipped, and the
+# coalescer thread keeps serving the writes after it
+def cancelled_write_is_skipped():
+    from concurrent.futures import Future
+    import partitions
+    from inventory_crud import count_inventory, create_inventory
+    from write_coalescer import coalescers
+
+    partitions.create_db_and_tables()
+    coalescer = coalescers[0]
+    cancelled = Future()
+    cancelled.cancel()
+    coalescer.queue.put((create_inventory, (new_item("cancelled"),), cancelled))
+    coalescer.start()
+    try:
+        item = coalescer.submit(create_inventory, new_item("a")).result(timeout=5)
+    finally:
+        coalescer.stop()
+    assert item.name == "a"
+    assert count_inventory() == 1
+
+
+# An async route waiting for the write lock does not hold up the event loop
+def async_write_waits_off_the_loop():
+    import asyncio
+    import threading
+    import partitions
+    from inventory_crud import create_inventory, run_write_async
+
+    partitions.create_db_and_tables()
+    locked = threading.Event()
+
+    def hold_write_lock():
+        with partitions.engines[0].connect() as conn:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            locked.set()
+            time.sleep(0.5)
+            conn.rollback()
+
+    async def main():
+        holder = threading.Thread(target=hold_write_lock)
+        holder.start()
+        locked.wait()
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        item = await run_write_async(create_inventory, new_item("a"))
+        ticker.cancel()
+        holder.join()
+        return item, ticks
+
+    item, ticks = asyncio.run(main())
+    assert item.name == "a"
+    assert ticks > 10, ticks
+
+
+SCENARIOS = {
+    "failed_write_keeps_batch_changes": failed_write_keeps_batch_changes,
+    "failed_commit_publishes_nothing": failed_commit_publishes_nothing,
+    "cancelled_write_is_skipped": cancelled_write_is_skipped,
+    "async_write_waits_off_the_loop": async_write_waits_off_the_loop,
+}
+
+
+def test_failed_write_keeps_batch_changes():
+    run_scenario(__file__, "failed_write_keeps_batch_changes")
+
+
+def test_failed_commit_publishes_nothing():
+    run_scenario(__file__, "failed_commit_publishes_nothing")
+
+
+def test_cancelled_write_is_skipped():
+    run_scenario(__file__, "cancelled_write_is_skipped")
+
+
+def test_async_write_waits_off_the_loop():
+    run_scenario(__file__, "async_write_waits_off_the_loop")
+
+
+if __name__ == "__main__":
+    run_from_command_line(SCENARIOS)
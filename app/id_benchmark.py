@@ -0,0 +1,90 @@
+# Insert throughput and database size of the inventory id formats
+#
+# Inserts the same devices into a new database once per id format, in
+# transactions of batch size rows, and prints the insert rate (overall and
+# over the last tenth of the rows, when the table is largest), the file size
+# and the size of the primary key index.
+#   uuid4 text     random ids as 32 hex characters (the default)
+#   uuid4 binary   random ids as 16 bytes
+#   uuid7 text     time-ordered ids as 32 hex characters
+#   uuid7 binary   time-ordered ids as 16 bytes (INVENTORY_COMPACT_IDS=1)
+#
+# python id_benchmark.py [rows] [batch size]
+import os
+import sys
+import tempfile
+import time
+import uuid
+from sqlalchemy import MetaData, Uuid, create_engine, insert
+import models
+from sample_inventory import device
+
+ID_FORMATS = [
+    ("uuid4 text", uuid.uuid4, Uuid),
+    ("uuid4 binary", uuid.uuid4, models.BinaryUUID),
+    ("uuid7 text", models.uuid7, Uuid),
+    ("uuid7 binary", models.uuid7, models.BinaryUUID),
+]
+
+
+# A copy of the inventory table with the id stored as id_type
+def inventory_table(id_type):
+    table = models.Inventory.__table__.to_metadata(MetaData())
+    table.c.id.type = id_type()
+    return table
+
+
+def benchmark(new_id, id_type, rows: int, batch_size: int) -> dict:
+    path = os.path.join(tempfile.mkdtemp(prefix="id-benchmark-"), "inventory.db")
+    engine = create_engine(f"sqlite:///{path}")
+    table = inventory_table(id_type)
+    table.metadata.create_all(engine)
+    devices = [device(i) for i in range(rows)]
+    tail_start = rows - rows // 10
+
+    started = time.perf_counter()
+    for start in range(0, rows, batch_size):
+        if start <= tail_start < start + batch_size:
+            tail_started = time.perf_counter()
+        batch = [{**row, "id": new_id()} for row in devices[start : start + batch_size]]
+        with engine.begin() as conn:
+            conn.execute(insert(table), batch)
+    finished = time.perf_counter()
+
+    with engine.connect() as conn:
+        try:
+            primary_key_size = conn.exec_driver_sql(
+                "SELECT sum(pgsize) FROM dbstat WHERE name = 'sqlite_autoindex_inventory_1'"
+            ).scalar()
+        except Exception:
+            # SQLite built without the dbstat table
+            primary_key_size = None
+    engine.dispose()
+    return {
+        "rows_per_second": rows / (finished - started),
+        "tail_rows_per_second": (rows - tail_start) / (finished - tail_started),
+        "file_size": os.path.getsize(path),
+        "primary_key_size": primary_key_size,
+    }
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    print(f"{rows} rows in batches of {batch_size}")
+    print(
+        f"{'id format':<14}{'rows/s':>10}{'last 10%':>10}"
+        f"{'file MB':>10}{'pk index MB':>13}"
+    )
+    for name, new_id, id_type in ID_FORMATS:
+        result = benchmark(new_id, id_type, rows, batch_size)
+        primary_key_size = (
+            f"{result['primary_key_size'] / 1e6:.1f}"
+            if result["primary_key_size"]
+            else "-"
+        )
+        print(
+            f"{name:<14}{result['rows_per_second']:>10.0f}"
+            f"{result['tail_rows_per_second']:>10.0f}"
+            f"{result['file_size'] / 1e6:>10.1f}{primary_key_size:>13}"
+        )
@@ -1,81 +1,210 @@
 # This file contains the API routes for the inventory items
+import json
 import uuid
-from fastapi import HTTPException, Depends, APIRouter
-from sqlmodel import select, Session
+from datetime import date
+from fastapi import HTTPException, APIRouter, Header, Query, Request, Response
+from fastapi.responses import StreamingResponse
 import models
-from db_conn import get_session
+from change_feed import sse_stream
+from inventory_crud import (
+    InventoryNotFound,
+    MoveIncomplete,
+    NameAlreadyExists,
+    VersionConflict,
+    count_inventory,
+    create_inventory,
+    delete_inventory,
+    find_inventory,
+    get_inventory,
+    run_write,
+    update_inventory,
+)
+from wire_formats import LIST_RESPONSES, negotiate
 
 
 inventory_api = APIRouter()
 
 
+# The ETag of an inventory item is its version number
+def version_etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def parse_if_match(if_match: str) -> int | None:
+    if if_match.strip() == "*":
+        return None
+    try:
+        return int(if_match.strip().removeprefix("W/").strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=412, detail="Invalid If-Match header")
+
+
 # Create a new inventory item
 @inventory_api.post("/inventory/api/", response_model=models.InventoryItems)
-def create_inventory_item(
-    inventory: models.InventoryBase, session: Session = Depends(get_session)
-):
-    db_inventory = select(models.Inventory).where(
-        models.Inventory.name == inventory.name
-    )
-
-    if session.exec(db_inventory).first():
+def create_inventory_item(inventory: models.InventoryBase):
+    try:
+        return run_write(create_inventory, inventory.model_dump())
+    except NameAlreadyExists:
         raise HTTPException(status_code=400, detail="Name already exists")
-    inventory = models.Inventory.model_validate(inventory)
-    session.add(inventory)
-    session.commit()
-    session.refresh(inventory)
-    return inventory
 
 
 # Get all inventory items
-@inventory_api.get("/inventory/api/", response_model=list[models.InventoryItems])
-def read_inventory_items(session: Session = Depends(get_session)):
-    inventory_items = session.exec(select(models.Inventory)).all()
-    return inventory_items
+# Pass limit (and offset) to get one page of items sorted by name
+@inventory_api.get(
+    "/inventory/api/",
+    response_model=list[models.InventoryItems],
+    responses=LIST_RESPONSES,
+)
+def read_inventory_items(
+    request: Request,
+    limit: int | None = Query(default=None, ge=1),
+    offset: int = Query(default=0, ge=0),
+):
+    inventory_items = find_inventory(limit=limit, offset=offset)
+    return negotiate(request, inventory_items)
+
+
+# Search inventory items, every filter given must match exactly
+# end_of_support_from and end_of_support_to select an end of support window
+# Searches that include location only read that location's partition
+@inventory_api.get(
+    "/inventory/api/search",
+    response_model=list[models.InventoryItems],
+    responses=LIST_RESPONSES,
+)
+def search_inventory_items(
+    request: Request,
+    name: str | None = None,
+    location: str | None = None,
+    state: str | None = None,
+    device_type: str | None = None,
+    make: str | None = None,
+    model: str | None = None,
+    end_of_support_from: date | None = None,
+    end_of_support_to: date | None = None,
+    limit: int | None = Query(default=None, ge=1),
+    offset: int = Query(default=0, ge=0),
+):
+    filters = {
+        "name": name,
+        "location": location,
+        "state": state,
+        "device_type": device_type,
+        "make": make,
+        "model": model,
+        "end_of_support_from": end_of_support_from,
+        "end_of_support_to": end_of_support_to,
+    }
+    inventory_items = find_inventory(filters, limit, offset)
+    return negotiate(request, inventory_items)
+
+
+# Count inventory items, takes the same filters as search
+@inventory_api.get("/inventory/api/count")
+def count_inventory_items(
+    name: str | None = None,
+    location: str | None = None,
+    state: str | None = None,
+    device_type: str | None = None,
+    make: str | None = None,
+    model: str | None = None,
+    end_of_support_from: date | None = None,
+    end_of_support_to: date | None = None,
+):
+    filters = {
+        "name": name,
+        "location": location,
+        "state": state,
+        "device_type": device_type,
+        "make": make,
+        "model": model,
+        "end_of_support_from": end_of_support_from,
+        "end_of_support_to": end_of_support_to,
+    }
+    return {"count": count_inventory(filters)}
+
+
+# Stream inventory changes as Server-Sent Events
+# Each event is named created, updated or deleted and its data is
+# {"op": ..., "item": {...}}. Only changes to items matching every filter
+# given are sent. Updates that take an item out of the filters are sent too,
+# with the item's new values. A client that falls too far behind gets a
+# resync event and the stream ends, reload the items before reconnecting.
+@inventory_api.get("/inventory/api/events")
+async def inventory_change_events(
+    name: str | None = None,
+    location: str | None = None,
+    state: str | None = None,
+    device_type: str | None = None,
+    make: str | None = None,
+    model: str | None = None,
+):
+    return StreamingResponse(
+        sse_stream(
+            lambda change: json.dumps(
+                {"op": change.op, "item": change.item.model_dump(mode="json")}
+            ),
+            name=name,
+            location=location,
+            state=state,
+            device_type=device_type,
+            make=make,
+            model=model,
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
 
 
 # Get a single inventory item
 @inventory_api.get(
     "/inventory/api/{inventory_id}", response_model=models.InventoryItems
 )
-def read_inventory_item(
-    inventory_id: uuid.UUID, session: Session = Depends(get_session)
-):
-    inventory = session.get(models.Inventory, inventory_id)
+def read_inventory_item(inventory_id: uuid.UUID, response: Response):
+    inventory = get_inventory(inventory_id)
     if inventory is None:
         raise HTTPException(status_code=404, detail="Inventory not found")
+    response.headers["ETag"] = version_etag(inventory.version)
     return inventory
 
 
 # Delete an inventory item
 @inventory_api.delete("/inventory/api/{inventory_id}")
-def delete_inventory_item(
-    inventory_id: uuid.UUID, session: Session = Depends(get_session)
-):
-    inventory = session.get(models.Inventory, inventory_id)
-    if inventory is None:
+def delete_inventory_item(inventory_id: uuid.UUID):
+    try:
+        run_write(delete_inventory, inventory_id)
+    except InventoryNotFound:
         raise HTTPException(status_code=404, detail="Inventory not found")
-    session.delete(inventory)
-    session.commit()
     return {"message": "Inventory item deleted successfully"}
 
 
 # Update an inventory item
+# Send the item's ETag in If-Match (412 on mismatch) or its version in the
+# body (409 on mismatch) to make sure nobody else changed it in between
 @inventory_api.patch(
     "/inventory/api/{inventory_id}", response_model=models.InventoryItems
 )
 def update_inventory_item(
     inventory_id: uuid.UUID,
     inventory: models.InventoryUpdate,
-    session: Session = Depends(get_session),
+    response: Response,
+    if_match: str | None = Header(default=None),
 ):
-    db_inventory = session.get(models.Inventory, inventory_id)
-    if db_inventory is None:
-        raise HTTPException(status_code=404, detail="Inventory not found")
     inventory_data = inventory.model_dump(exclude_unset=True)
-    for key, value in inventory_data.items():
-        setattr(db_inventory, key, value)
-    session.add(db_inventory)
-    session.commit()
-    session.refresh(db_inventory)
+    expected_version = inventory_data.pop("version", None)
+    if if_match is not None:
+        expected_version = parse_if_match(if_match)
+    try:
+        db_inventory = run_write(
+            update_inventory, inventory_id, inventory_data, expected_version
+        )
+    except InventoryNotFound:
+        raise HTTPException(status_code=404, detail="Inventory not found")
+    except VersionConflict as e:
+        raise HTTPException(
+            status_code=412 if if_match is not None else 409, detail=str(e)
+        )
+    except MoveIncomplete as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    response.headers["ETag"] = version_etag(db_inventory.version)
     return db_inventory
@@ -0,0 +1,86 @@
+# Conditional updates of the REST API
+#
+# GET returns the item's version as its ETag. PATCH checks the version sent
+# in If-Match (412 on mismatch) or in the body (409 on mismatch), and an
+# empty PATCH leaves the item as it is.
+#
+# pytest inventory_api_test.py
+# python inventory_api_test.py <scenario>   runs one scenario in this process
+import uuid
+from scenarios import new_item, published_changes, run_from_command_line, run_scenario
+
+
+def version_checks():
+    from fastapi.testclient import TestClient
+    from main import app
+
+    with TestClient(app) as client:
+        item = client.post("/inventory/api/", json=new_item("a")).json()
+        url = f"/inventory/api/{item['id']}"
+
+        response = client.get(url)
+        assert response.headers["ETag"] == '"1"'
+
+        response = client.patch(
+            url, json={"state": "OFFLINE"}, headers={"If-Match": '"2"'}
+        )
+        assert response.status_code == 412
+        response = client.patch(url, json={"state": "OFFLINE", "version": 2})
+        assert response.status_code == 409
+        response = client.patch(
+            f"/inventory/api/{uuid.uuid4()}", json={"state": "OFFLINE"}
+        )
+        assert response.status_code == 404
+
+        response = client.patch(
+            url, json={"state": "OFFLINE"}, headers={"If-Match": '"1"'}
+        )
+        assert response.status_code == 200
+        assert response.headers["ETag"] == '"2"'
+        assert response.json()["version"] == 2
+        response = client.patch(url, json={"state": "ONLINE", "version": 2})
+        assert response.status_code == 200
+        assert response.headers["ETag"] == '"3"'
+        assert client.get(url).headers["ETag"] == '"3"'
+
+
+# PATCH {} returns the item unchanged, without a new version or a change
+# event, and still checks the version it was sent
+def empty_update_changes_nothing():
+    from fastapi.testclient import TestClient
+    from main import app
+
+    with TestClient(app) as client:
+        item = client.post("/inventory/api/", json=new_item("a")).json()
+        url = f"/inventory/api/{item['id']}"
+        with published_changes() as changes:
+            response = client.patch(url, json={})
+            assert response.status_code == 200
+            assert response.json() == item
+            assert response.headers["ETag"] == '"1"'
+            assert client.patch(url, json={"version": 1}).status_code == 200
+            assert client.patch(url, json={"version": 2}).status_code == 409
+            response = client.patch(url, json={}, headers={"If-Match": '"2"'})
+            assert response.status_code == 412
+        assert changes == []
+        assert client.get(url).json()["version"] == 1
+        response = client.patch(f"/inventory/api/{uuid.uuid4()}", json={})
+        assert response.status_code == 404
+
+
+SCENARIOS = {
+    "version_checks": version_checks,
+    "empty_update_changes_nothing": empty_update_changes_nothing,
+}
+
+
+def test_version_checks():
+    run_scenario(__file__, "version_checks")
+
+
+def test_empty_update_changes_nothing():
+    run_scenario(__file__, "empty_update_changes_nothing")
+
+
+if __name__ == "__main__":
+    run_from_command_line(SCENARIOS)
@@ -0,0 +1,347 @@
+# This file contains the database read and write paths shared by the REST
+# API, the web UI and GraphQL
+#
+# The write functions take a session and do not commit, run them with
+# run_write() so they either get their own transaction or are group committed
+# with other writes by the write coalescer. run_write() also picks the
+# partition the write runs on when storage is partitioned.
+#
+# With INVENTORY_READ_REPLICA=1 the reads are served from the in-memory
+# replica (read_replica.py) once it is loaded.
+import asyncio
+import heapq
+import itertools
+import uuid
+from sqlmodel import Session, delete, func, select, update
+import models
+import partitions
+import read_replica
+from change_feed import broadcaster, record_change
+from write_coalescer import coalescers
+
+
+class InventoryNotFound(Exception):
+    pass
+
+
+class NameAlreadyExists(Exception):
+    pass
+
+
+class VersionConflict(Exception):
+    pass
+
+
+# The write was saved but the item could not be inserted into the partition
+# of its new location yet, it is retried in the background
+class MoveIncomplete(Exception):
+    pass
+
+
+# Get an inventory item by id, None if there is no such item
+def get_inventory(inventory_id: uuid.UUID) -> models.Inventory | None:
+    if read_replica.replica.loaded:
+        return read_replica.replica.get(inventory_id)
+    # The remembered partition first, then wherever the item is now
+    for cached in (True, False):
+        partition = partitions.locate(inventory_id, cached)
+        if partition is None:
+            return None
+        item = partitions.fan_out(
+            lambda session: session.get(models.Inventory, inventory_id), [partition]
+        )[0]
+        if item is not None or not partitions.PARTITIONED:
+            return item
+    return None
+
+
+# Sort key of paginated results, the same order as ORDER BY name, id in SQLite
+def page_order(row):
+    return (row.name is not None, row.name or "", row.id.hex)
+
+
+# Filters given (not None) and the partitions they need to read. A location
+# filter only reads that location's partition, other queries read every
+# partition.
+def filter_partitions(filters: dict | None) -> tuple[dict, list[int]]:
+    filters = {
+        column: value for column, value in (filters or {}).items() if value is not None
+    }
+    if "location" in filters:
+        return filters, [partitions.partition_for(filters["location"])]
+    return filters, list(range(partitions.PARTITION_COUNT))
+
+
+# end_of_support_from and end_of_support_to select an end of support window
+# (both ends included), other filters are column: value
+def filter_conditions(filters: dict) -> list:
+    conditions = []
+    for key, value in filters.items():
+        if key == "end_of_support_from":
+            conditions.append(models.Inventory.end_of_support >= value)
+        elif key == "end_of_support_to":
+            conditions.append(models.Inventory.end_of_support <= value)
+        else:
+            conditions.append(getattr(models.Inventory, key) == value)
+    return conditions
+
+
+# Get the inventory items matching every filter given, see filter_conditions
+# With a limit the items are sorted by name and id. When several partitions
+# are read, each returns the name and id of its first offset + limit items,
+# and only the items on the merged page are loaded.
+def find_inventory(
+    filters: dict | None = None, limit: int | None = None, offset: int = 0
+) -> list[models.Inventory]:
+    filters, partition_ids = filter_partitions(filters)
+    if read_replica.replica.loaded:
+        return read_replica.replica.find(filters, limit, offset)
+    conditions = filter_conditions(filters)
+    order = (models.Inventory.name, models.Inventory.id)
+
+    if len(partition_ids) == 1:
+        statement = select(models.Inventory).where(*conditions)
+        if limit is not None:
+            statement = statement.order_by(*order).offset(offset).limit(limit)
+        return list(
+            partitions.fan_out(
+                lambda session: session.exec(statement).all(), partition_ids
+            )[0]
+        )
+
+    if limit is None:
+        statement = select(models.Inventory).where(*conditions)
+        results = partitions.fan_out(lambda session: session.exec(statement).all())
+        return [item for items in results for item in items]
+
+    keys = (
+        select(models.Inventory.name, models.Inventory.id)
+        .where(*conditions)
+        .order_by(*order)
+        .limit(offset + limit)
+    )
+    results = partitions.fan_out(lambda session: session.exec(keys).all())
+    merged = heapq.merge(
+        *([(row, partition) for row in rows] for partition, rows in enumerate(results)),
+        key=lambda entry: page_order(entry[0]),
+    )
+    page = list(itertools.islice(merged, offset, offset + limit))
+
+    page_ids = {}
+    for row, partition in page:
+        page_ids.setdefault(partition, []).append(row.id)
+    loaded = partitions.fan_out(
+        lambda session: session.exec(
+            select(models.Inventory).where(
+                models.Inventory.id.in_(page_ids[partitions.partition_of(session)])
+            )
+        ).all(),
+        page_ids,
+    )
+    items = {item.id: item for items in loaded for item in items}
+    # Items deleted since their key was read are left out
+    return [items[row.id] for row, _ in page if row.id in items]
+
+
+# Number of inventory items matching every filter given
+def count_inventory(filters: dict | None = None) -> int:
+    filters, partition_ids = filter_partitions(filters)
+    if read_replica.replica.loaded:
+        return read_replica.replica.count(filters)
+    statement = (
+        select(func.count())
+        .select_from(models.Inventory)
+        .where(*filter_conditions(filters))
+    )
+    return sum(
+        partitions.fan_out(lambda session: session.exec(statement).one(), partition_ids)
+    )
+
+
+# Create an inventory item
+def create_inventory(session: Session, data: dict) -> models.InventoryItems:
+    name = data.get("name")
+    if name and (
+        session.exec(
+            select(models.Inventory.id).where(models.Inventory.name == name)
+        ).first()
+        or partitions.name_in_other_partitions(session, name)
+    ):
+        raise NameAlreadyExists(f"Name '{name}' already exists")
+    inventory = models.Inventory.model_validate(data)
+    session.add(inventory)
+    session.flush()
+    item = models.InventoryItems.model_validate(inventory)
+    partitions.remember(item.id, partitions.partition_of(session))
+    record_change(session, "created", item)
+    return item
+
+
+# Start the write transaction if the sqlite3 driver has not started it yet
+# (it only does at the first write, the write coalescer starts its own), so
+# rows read before they are changed cannot change in between
+def begin_write(session: Session):
+    connection = session.connection()
+    if not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+# Update an inventory item
+# Issues a single UPDATE ... WHERE id = ? [AND version = ?] RETURNING *
+# so the read, the version check and the write happen in one statement
+# and concurrent edits cannot silently overwrite each other.
+# While a change feed subscriber filters on field values the row is read
+# first, in the same write transaction, so the change also carries the values
+# the item had before (and a subscriber filtered on the old location sees it
+# move).
+def update_inventory(
+    session: Session,
+    inventory_id: uuid.UUID,
+    data: dict,
+    expected_version: int | None = None,
+) -> models.InventoryItems:
+    columns = models.Inventory.__table__.columns
+    if not data:
+        # Nothing to change, the item keeps its version and no change is sent
+        row = session.exec(
+            select(*columns).where(models.Inventory.id == inventory_id)
+        ).first()
+        if row is None:
+            raise InventoryNotFound(f"Inventory item with id {inventory_id} not found")
+        if expected_version is not None and row.version != expected_version:
+            raise VersionConflict(
+                f"Inventory item {inventory_id} was modified by another request"
+            )
+        return models.InventoryItems.model_validate(row._mapping)
+
+    previous = None
+    if broadcaster.has_filtered_subscribers():
+        begin_write(session)
+        before = session.exec(
+            select(*columns).where(models.Inventory.id == inventory_id)
+        ).first()
+        if before is not None:
+            previous = models.InventoryItems.model_validate(before._mapping)
+
+    statement = update(models.Inventory).where(models.Inventory.id == inventory_id)
+    if expected_version is not None:
+        statement = statement.where(models.Inventory.version == expected_version)
+    statement = statement.values(
+        **data, version=models.Inventory.version + 1
+    ).returning(*columns)
+
+    row = session.exec(statement).first()
+    if row is None:
+        # Only look the row up again to explain why nothing was updated
+        if session.exec(
+            select(models.Inventory.id).where(models.Inventory.id == inventory_id)
+        ).first():
+            raise VersionConflict(
+                f"Inventory item {inventory_id} was modified by another request"
+            )
+        raise InventoryNotFound(f"Inventory item with id {inventory_id} not found")
+    item = models.InventoryItems.model_validate(row._mapping)
+    if "location" in data:
+        partitions.move_to_location_partition(session, item)
+    record_change(session, "updated", item, previous)
+    return item
+
+
+# Set the state of several inventory items with one statement, used by the
+# reachability poller. Items that are already in that state are not touched.
+# Returns the items that changed. Their old states are read first only while
+# a change feed subscriber filters on field values, like in update_inventory.
+def set_inventory_state(
+    session: Session, inventory_ids: list[uuid.UUID], state: str
+) -> list[models.InventoryItems]:
+    changing = (
+        models.Inventory.id.in_(inventory_ids),
+        models.Inventory.state.is_distinct_from(state),
+    )
+    previous_states = None
+    if broadcaster.has_filtered_subscribers():
+        begin_write(session)
+        previous_states = dict(
+            session.exec(
+                select(models.Inventory.id, models.Inventory.state).where(*changing)
+            ).all()
+        )
+    rows = session.exec(
+        update(models.Inventory)
+        .where(*changing)
+        .values(state=state, version=models.Inventory.version + 1)
+        .returning(*models.Inventory.__table__.columns)
+    ).all()
+    items = [models.InventoryItems.model_validate(row._mapping) for row in rows]
+    for item in items:
+        previous = None
+        if previous_states is not None:
+            previous = item.model_copy(
+                update={
+                    "state": previous_states.get(item.id),
+                    "version": item.version - 1,
+                }
+            )
+        record_change(session, "updated", item, previous)
+    return items
+
+
+# Delete an inventory item
+def delete_inventory(session: Session, inventory_id: uuid.UUID) -> None:
+    deleted = session.exec(
+        delete(models.Inventory)
+        .where(models.Inventory.id == inventory_id)
+        .returning(*models.Inventory.__table__.columns)
+    ).first()
+    if deleted is None:
+        raise InventoryNotFound(f"Inventory item with id {inventory_id} not found")
+    partitions.forget(inventory_id)
+    record_change(
+        session, "deleted", models.InventoryItems.model_validate(deleted._mapping)
+    )
+
+
+# Run a write function in its own transaction, or queue it for the next group
+# commit when write coalescing is enabled. Exceptions raised by the write are
+# re-raised here either way, a write that moved its item to a partition it
+# could not be inserted into raises MoveIncomplete.
+def run_write(write, *args):
+    # The first argument of every write is the new item's data or an item id
+    partition = partitions.write_partition(args[0])
+    try:
+        result = run_write_on(partition, write, *args)
+    except InventoryNotFound:
+        # The item may have moved to another partition since it was located
+        moved_to = partitions.write_partition(args[0], cached=False)
+        if moved_to == partition:
+            raise
+        result = run_write_on(moved_to, write, *args)
+    if (
+        isinstance(result, models.InventoryItems)
+        and result.id in partitions.unfinished_moves
+    ):
+        raise MoveIncomplete(
+            f"Inventory item {result.id} was saved but is not in its new location yet"
+        )
+    return result
+
+
+def run_write_on(partition: int, write, *args):
+    coalescer = coalescers[partition]
+    if coalescer.running:
+        return coalescer.submit(write, *args).result()
+    with Session(partitions.engines[partition]) as session:
+        result = write(session, *args)
+        session.commit()
+        return result
+
+
+# Same as run_write() for async routes, waits for the write without blocking
+# the event loop
+async def run_write_async(write, *args):
+    if coalescers[0].running and not partitions.PARTITIONED:
+        return await asyncio.wrap_future(coalescers[0].submit(write, *args))
+    # A write of its own waits for the write lock (up to the busy timeout),
+    # and finding the partition of an id not located before reads every
+    # partition, do both off the loop
+    return await asyncio.to_thread(run_write, write, *args)
@@ -1,11 +1,27 @@
 # This file contains the UI routes for the inventory items
 import uuid
-from fastapi import APIRouter, Form, HTTPException, Request, Depends
-from fastapi.responses import HTMLResponse, RedirectResponse, Response
+from fastapi import APIRouter, Form, HTTPException, Request
+from fastapi.responses import (
+    HTMLResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.templating import Jinja2Templates
-from sqlmodel import Session, select
 import models
-from db_conn import engine, get_session
+from change_feed import sse_stream
+from inventory_crud import (
+    InventoryNotFound,
+    MoveIncomplete,
+    NameAlreadyExists,
+    VersionConflict,
+    create_inventory,
+    delete_inventory,
+    find_inventory,
+    get_inventory,
+    run_write_async,
+    update_inventory,
+)
 from datetime import date
 
 
@@ -16,26 +32,35 @@ templates = Jinja2Templates(directory="templates")
 
 # Get all inventory for the web page
 @inventory_ui.get("/inventory", response_class=HTMLResponse, include_in_schema=False)
-async def read_item(request: Request, session: Session = Depends(get_session)):
-    inventory = session.exec(select(models.Inventory)).all()
+async def read_item(request: Request):
+    inventory = find_inventory()
     return templates.TemplateResponse(
         "inventory.html", {"request": request, "inventory": inventory}
     )
 
 
+# Live changes for the inventory page, each event carries the rendered row
+@inventory_ui.get("/inventory/events", include_in_schema=False)
+async def inventory_events():
+    row_template = templates.get_template("inventory_row.html")
+    return StreamingResponse(
+        sse_stream(lambda change: row_template.render(item=change.item)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
 @inventory_ui.get("/inventory/add", include_in_schema=False)
-def get_inventory_ui(request: Request, session: Session = Depends(get_session)):
-    inventory = session.exec(select(models.Inventory)).all()
+def get_inventory_ui(request: Request):
+    inventory = find_inventory()
     return templates.TemplateResponse(
         "table_row.html", {"request": request, "inventory": inventory}
     )
 
 
 @inventory_ui.get("/inventory/{item_id}/edit", include_in_schema=False)
-async def edit_inventory_item(
-    request: Request, item_id: uuid.UUID, session: Session = Depends(get_session)
-):
-    inventory_item = session.get(models.Inventory, item_id)
+async def edit_inventory_item(request: Request, item_id: uuid.UUID):
+    inventory_item = get_inventory(item_id)
     if not inventory_item:
         raise HTTPException(status_code=404, detail="Item not found")
     return templates.TemplateResponse(
@@ -56,41 +81,34 @@ async def add_inventory_ui(
     model: str = Form(...),
     os_version: str = Form(...),
     end_of_support: date = Form(...),
-    session: Session = Depends(get_session),
 ):
-    existing_inventory = session.exec(
-        select(models.Inventory).where(models.Inventory.name == name)
-    ).first()
-    if existing_inventory:
+    try:
+        await run_write_async(
+            create_inventory,
+            {
+                "name": name,
+                "ip_address": ip_address,
+                "location": location,
+                "state": state,
+                "device_type": device_type,
+                "make": make,
+                "model": model,
+                "os_version": os_version,
+                "end_of_support": end_of_support,
+            },
+        )
+    except NameAlreadyExists:
         return Response(content="Name already exists", status_code=400)
 
-    inventory = models.Inventory(
-        name=name,
-        ip_address=ip_address,
-        location=location,
-        state=state,
-        device_type=device_type,
-        make=make,
-        model=model,
-        os_version=os_version,
-        end_of_support=end_of_support,
-    )
-    session.add(inventory)
-    session.commit()
-    session.refresh(inventory)
-
     return Response(status_code=204, headers={"HX-Redirect": "/inventory"})
 
 
 @inventory_ui.delete("/inventory/{item_id}", include_in_schema=False)
-async def delete_inventory_ui(
-    item_id: uuid.UUID, session: Session = Depends(get_session)
-):
-    inventory_item = session.get(models.Inventory, item_id)
-    if not inventory_item:
+async def delete_inventory_ui(item_id: uuid.UUID):
+    try:
+        await run_write_async(delete_inventory, item_id)
+    except InventoryNotFound:
         raise HTTPException(status_code=404, detail="Item not found")
-    session.delete(inventory_item)
-    session.commit()
     return Response(status_code=204, headers={"HX-Redirect": "/inventory"})
 
 
@@ -110,26 +128,39 @@ async def update_inventory_item(
     model: str = Form(...),
     os_version: str = Form(...),
     end_of_support: date = Form(...),
-    session: Session = Depends(get_session),
+    version: int | None = Form(None),
 ):
-    inventory_item = session.get(models.Inventory, item_id)
-    if not inventory_item:
-        raise HTTPException(status_code=404, detail="Item not found")
-
     # Update the inventory item with the provided data
-    inventory_item.name = name
-    inventory_item.ip_address = ip_address
-    inventory_item.location = location
-    inventory_item.state = state
-    inventory_item.device_type = device_type
-    inventory_item.make = make
-    inventory_item.model = model
-    inventory_item.os_version = os_version
-    inventory_item.end_of_support = end_of_support
-
-    session.add(inventory_item)
-    session.commit()
-    session.refresh(inventory_item)
+    try:
+        inventory_item = await run_write_async(
+            update_inventory,
+            item_id,
+            {
+                "name": name,
+                "ip_address": ip_address,
+                "location": location,
+                "state": state,
+                "device_type": device_type,
+                "make": make,
+                "model": model,
+                "os_version": os_version,
+                "end_of_support": end_of_support,
+            },
+            version,
+        )
+    except InventoryNotFound:
+        raise HTTPException(status_code=404, detail="Item not found")
+    except VersionConflict:
+        return Response(
+            content="Item was changed by someone else, reload and try again",
+            status_code=409,
+        )
+    except MoveIncomplete:
+        return Response(
+            content="Item was saved but is not at its new location yet, "
+            "reload in a few seconds",
+            status_code=503,
+        )
     print(f"Updated item: {inventory_item}")
     return Response(
         content="<script>window.location.reload();</script>", media_type="text/html"
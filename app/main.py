@@ -3,13 +3,17 @@ from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import strawberry
-from strawberry.fastapi import GraphQLRouter
-import db_conn
+import partitions
+from admission import AdmissionControlMiddleware, admission_api
+from compression import CompressionMiddleware
+import reachability
+import read_replica
+import write_coalescer
 from inventory_api import inventory_api
 from inventory_ui import inventory_ui
 from contextlib import asynccontextmanager
-from graphql_schema import schema
-
+from change_feed import subscriptions_closed_on_shutdown
+from graphql_schema import InventoryGraphQLRouter, schema
 
 templates = Jinja2Templates(directory="templates")
 
@@ -19,8 +23,21 @@ templates = Jinja2Templates(directory="templates")
 # look at using Alembic for migrations
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    db_conn.create_db_and_tables()
-    yield
+    partitions.create_db_and_tables()
+    # Loaded before anything else writes, writes from other processes are not
+    # seen by the replica
+    if read_replica.READ_REPLICA:
+        read_replica.replica.load()
+    if write_coalescer.WRITE_COALESCING:
+        for coalescer in write_coalescer.coalescers:
+            coalescer.start()
+    if reachability.POLLER_ENABLED:
+        reachability.poller.start()
+    async with subscriptions_closed_on_shutdown():
+        yield
+    await reachability.poller.stop()
+    for coalescer in write_coalescer.coalescers:
+        coalescer.stop()
 
 
 app = FastAPI(
@@ -29,13 +46,19 @@ app = FastAPI(
     description="Network Inventory API documentation with REST and GraphQL endpoints.",
     version="1.0.0",
 )
+app.add_middleware(CompressionMiddleware)
+# Added last so it runs first and sheds load before any other work is done
+app.add_middleware(AdmissionControlMiddleware)
+
 # GraphQL router
-graphql_app = GraphQLRouter(schema)
+graphql_app = InventoryGraphQLRouter(schema)
 
 # Mount static files and include routers
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.include_router(inventory_api)
 app.include_router(inventory_ui)
+app.include_router(admission_api)
+app.include_router(reachability.reachability_api)
 app.include_router(graphql_app, prefix="/graphql")
 
 
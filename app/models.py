@@ -1,8 +1,69 @@
+from sqlalchemy import Index, LargeBinary, TypeDecorator, Uuid
 from sqlmodel import Field, Session, SQLModel
+import os
+import secrets
+import threading
+import time
 import uuid
 from datetime import date
 from typing import Optional
 
+# Compact ids
+# With INVENTORY_COMPACT_IDS=1 new ids are UUIDv7 and ids are stored as 16
+# bytes instead of 32 hex characters. A UUIDv7 starts with a millisecond
+# timestamp, so new rows go to the end of the primary key index instead of a
+# random place in it. The API still takes and returns normal UUID strings.
+# db_conn.upgrade_db converts existing databases on startup.
+COMPACT_IDS = os.environ.get("INVENTORY_COMPACT_IDS", "0") == "1"
+
+uuid7_lock = threading.Lock()
+uuid7_last = [0, 0]  # millisecond, counter
+
+
+# UUID version 7 (RFC 9562): 48 bit Unix time in milliseconds, a 12 bit
+# counter that keeps ids made in the same millisecond in order, 62 random bits
+def uuid7() -> uuid.UUID:
+    with uuid7_lock:
+        millisecond = time.time_ns() // 1_000_000
+        last_millisecond, counter = uuid7_last
+        if millisecond > last_millisecond:
+            # Start low so there is room to count up
+            counter = secrets.randbits(11)
+        else:
+            # Same millisecond, or the clock went back
+            millisecond = last_millisecond
+            counter += 1
+            if counter > 0xFFF:
+                millisecond += 1
+                counter = 0
+        uuid7_last[:] = [millisecond, counter]
+    return uuid.UUID(
+        int=millisecond << 80
+        | 0x7 << 76
+        | counter << 64
+        | 0b10 << 62
+        | secrets.randbits(62)
+    )
+
+
+new_inventory_id = uuid7 if COMPACT_IDS else uuid.uuid4
+
+
+# Stores a UUID as 16 bytes, SQLite has no native UUID type
+class BinaryUUID(TypeDecorator):
+    impl = LargeBinary(16)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, uuid.UUID):
+            value = uuid.UUID(str(value))
+        return value.bytes
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else uuid.UUID(bytes=bytes(value))
+
 
 # Define the SQLModel
 # Fields - name, ip_address, location, device_type, make, model, os version, end_of_support
@@ -15,17 +76,29 @@ class InventoryBase(SQLModel):
     make: str | None = Field(index=True)
     model: str | None = Field(index=True)
     os_version: str | None = Field(default=None)
-    end_of_support: date | None = Field(default=None)
+    # Searched and counted by end of support window
+    end_of_support: date | None = Field(default=None, index=True)
 
 
 class Inventory(InventoryBase, table=True):
+    # Per-site queries filter on location and often state as well
+    # (query_plan_test.py checks that these queries use an index)
+    __table_args__ = (Index("ix_inventory_location_state", "location", "state"),)
+
     # id: int | None = Field(default=None, primary_key=True)
-    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    id: uuid.UUID = Field(
+        default_factory=new_inventory_id,
+        primary_key=True,
+        sa_type=BinaryUUID if COMPACT_IDS else Uuid,
+    )
+    # Incremented on every update, used for optimistic locking
+    version: int = Field(default=1)
 
 
 class InventoryItems(InventoryBase):
     # id: int
     id: uuid.UUID
+    version: int
 
 
 class InventoryUpdate(SQLModel):
@@ -38,3 +111,5 @@ class InventoryUpdate(SQLModel):
     model: Optional[str] = None
     os_version: Optional[str] = None
     end_of_support: Optional[date] = None
+    # Expected current version, the update fails with 409 if it has changed
+    version: Optional[int] = None
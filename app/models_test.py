@@ -0,0 +1,46 @@
+# UUIDv7 ids
+#
+# Ids made in the same millisecond, more of them than the counter holds, and
+# ids made after the clock went back still sort in the order they were made.
+#
+# pytest models_test.py
+import uuid
+import pytest
+import models
+
+MILLISECOND = 1_700_000_000_000
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [MILLISECOND * 1_000_000]
+    monkeypatch.setattr(models.time, "time_ns", lambda: now[0])
+    monkeypatch.setattr(models, "uuid7_last", [0, 0])
+    return now
+
+
+def timestamp(id: uuid.UUID) -> int:
+    return id.int >> 80
+
+
+def test_same_millisecond_ids_are_ordered(clock):
+    ids = [models.uuid7() for _ in range(5000)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+    assert all(id.version == 7 and id.variant == uuid.RFC_4122 for id in ids)
+    # Past 4096 ids the counter runs out and the timestamp moves on by one
+    assert timestamp(ids[0]) == MILLISECOND
+    assert timestamp(ids[-1]) == MILLISECOND + 1
+
+
+def test_ids_stay_ordered_when_the_clock_goes_back(clock):
+    before = models.uuid7()
+    clock[0] -= 1_000 * 1_000_000
+    after = [models.uuid7() for _ in range(10)]
+    assert [before, *after] == sorted([before, *after])
+    assert timestamp(after[-1]) == MILLISECOND
+
+    clock[0] += 2_000 * 1_000_000
+    later = models.uuid7()
+    assert later > after[-1]
+    assert timestamp(later) == MILLISECOND + 1_000
@@ -0,0 +1,325 @@
+# Location-partitioned storage
+#
+# With INVENTORY_PARTITIONS=N (N > 1) inventory items are spread over N SQLite
+# files, inventory-p0.db ... inventory-p<N-1>.db, by a hash of their location.
+# The files are created next to the main database, or in
+# INVENTORY_PARTITION_DIR. Every partition has its own write lock and its own
+# write coalescer, so writes to different sites do not wait for each other.
+#
+# Creates and reads filtered on location go straight to the location's
+# partition. Other reads run on every partition in parallel and the results
+# are merged (find_inventory in inventory_crud). An id does not say where an
+# item lives and items move when their location changes, so the partition of
+# each id is kept in memory (locate). An id that is not there yet is looked
+# up on every partition once.
+#
+# Moving an item deletes it from its partition and records the move in that
+# partition's partition_moves table, in the same transaction. Once that
+# commits the item is inserted into its new partition and the record removed
+# (move_to_location_partition). A move whose insert fails is tried again a
+# few times with backoff and then in the background until it succeeds, as
+# well as by the next move out of the same partition and at startup, so items
+# are never lost. The write that moved the item fails with MoveIncomplete
+# (inventory_crud) while its move has not finished.
+#
+# python partitions.py copies the items of the main database into the
+# partitions, run it once when enabling partitioning on an existing database.
+import logging
+import os
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import Column, Integer, MetaData, Table, Text, event
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import Session, create_engine, delete, select
+import db_conn
+import models
+
+PARTITION_COUNT = max(1, int(os.environ.get("INVENTORY_PARTITIONS", "1")))
+PARTITIONED = PARTITION_COUNT > 1
+PARTITION_DIR = os.path.abspath(
+    os.environ.get("INVENTORY_PARTITION_DIR", os.path.dirname(db_conn.sqlite_file_name))
+)
+# Seconds to wait before trying failed moves again while the moving write
+# waits, after that they are retried in the background every
+# MOVE_RETRY_INTERVAL seconds
+MOVE_RETRY_DELAYS = (0.05, 0.2, 1.0)
+MOVE_RETRY_INTERVAL = 5.0
+
+
+logger = logging.getLogger(__name__)
+
+# Moves out of a partition that still have to be inserted into their target
+moves = Table(
+    "partition_moves",
+    MetaData(),
+    Column("seq", Integer, primary_key=True),
+    Column("target", Integer, nullable=False),
+    # The item as JSON
+    Column("item", Text, nullable=False),
+)
+
+
+def partition_file_name(partition: int) -> str:
+    return os.path.join(PARTITION_DIR, f"inventory-p{partition}.db")
+
+
+if PARTITIONED:
+    engines = [
+        create_engine(
+            f"sqlite:///{partition_file_name(partition)}",
+            connect_args=db_conn.connect_args,
+        )
+        for partition in range(PARTITION_COUNT)
+    ]
+    # Runs the per-partition queries of a read in parallel
+    executor = ThreadPoolExecutor(PARTITION_COUNT, thread_name_prefix="partition")
+    # One apply_moves per partition at a time, so a move is not replayed
+    # after the item has moved on
+    move_locks = [threading.Lock() for _ in engines]
+else:
+    engines = [db_conn.engine]
+    executor = None
+
+# Item id: partition, see locate()
+directory = {}
+# Ids of items whose last move has not been inserted into their new partition
+unfinished_moves = set()
+# Partitions with a background retry of their moves scheduled
+retry_scheduled = set()
+retry_lock = threading.Lock()
+
+
+def create_db_and_tables():
+    for engine in engines:
+        db_conn.create_db_and_tables(engine)
+    if PARTITIONED:
+        for partition, engine in enumerate(engines):
+            moves.create(engine, checkfirst=True)
+            # Left over by a crash or a failed insert
+            apply_moves(partition)
+
+
+# Partition of a location, stable across restarts (unlike hash())
+def partition_for(location: str | None) -> int:
+    return zlib.crc32((location or "").encode()) % PARTITION_COUNT
+
+
+def partition_of(session: Session) -> int:
+    return engines.index(session.get_bind())
+
+
+# Run query(session) on the given partitions (all by default) in parallel,
+# returns the results in partition order
+def fan_out(query, partitions=None) -> list:
+    partitions = list(range(PARTITION_COUNT) if partitions is None else partitions)
+
+    def run(partition):
+        with Session(engines[partition]) as session:
+            return query(session)
+
+    if len(partitions) == 1:
+        return [run(partitions[0])]
+    return list(executor.map(run, partitions))
+
+
+# Partition of an item id, None if no partition has it. With cached the
+# partition remembered for the id is returned without checking it, it is out
+# of date when the item moved or was deleted since. Callers that do not find
+# the item there locate it again with cached=False.
+def locate(item_id, cached=True) -> int | None:
+    if not PARTITIONED:
+        return 0
+    if cached and item_id in directory:
+        return directory[item_id]
+    found = fan_out(
+        lambda session: session.exec(
+            select(models.Inventory.id).where(models.Inventory.id == item_id)
+        ).first()
+        is not None
+    )
+    if True not in found:
+        directory.pop(item_id, None)
+        return None
+    directory[item_id] = found.index(True)
+    return directory[item_id]
+
+
+# Remember the partition of a new item, forget a deleted one. Called by the
+# writes, before their commit, a write that is rolled back leaves a wrong
+# entry that locate() corrects.
+def remember(item_id, partition: int):
+    if PARTITIONED:
+        directory[item_id] = partition
+
+
+def forget(item_id):
+    directory.pop(item_id, None)
+
+
+# Partition a write runs on, key is the data of a new item or the id of an
+# existing one. Ids that are not found go to partition 0, where the write
+# fails with InventoryNotFound.
+def write_partition(key, cached=True) -> int:
+    if not PARTITIONED:
+        return 0
+    if isinstance(key, dict):
+        return partition_for(key.get("location"))
+    partition = locate(key, cached)
+    return 0 if partition is None else partition
+
+
+# True if a partition other than the session's has an item with this name
+def name_in_other_partitions(session: Session, name: str) -> bool:
+    if not PARTITIONED:
+        return False
+    current = partition_of(session)
+    return any(
+        fan_out(
+            lambda other: other.exec(
+                select(models.Inventory.id).where(models.Inventory.name == name)
+            ).first()
+            is not None,
+            [partition for partition in range(PARTITION_COUNT) if partition != current],
+        )
+    )
+
+
+# Called by update_inventory after a location change. If the new location
+# belongs to another partition the row is deleted from this one and the move
+# recorded, the item is inserted into the other partition after this session
+# commits (apply_committed_moves). Nothing is taken from the other partition
+# while this partition's write lock is held, so two partitions moving items
+# to each other cannot wait on each other. In between the item is in neither
+# partition for a moment, the write returns once it is in its new one (or
+# fails with MoveIncomplete if it could not be inserted there yet).
+def move_to_location_partition(session: Session, item: models.InventoryItems):
+    target = partition_for(item.location)
+    if target == partition_of(session):
+        return
+    session.exec(delete(models.Inventory).where(models.Inventory.id == item.id))
+    session.exec(moves.insert().values(target=target, item=item.model_dump_json()))
+    session.info["partition_moves"] = True
+
+
+# Insert the items recorded in a partition's partition_moves into their new
+# partitions, trying again after each of MOVE_RETRY_DELAYS while moves fail.
+# Moves that still failed stay recorded, are retried in the background and
+# their items are in unfinished_moves. Returns True if every move finished.
+def apply_moves(partition: int) -> bool:
+    for delay in (*MOVE_RETRY_DELAYS, None):
+        with move_locks[partition]:
+            if apply_recorded_moves(partition):
+                return True
+        if delay is not None:
+            time.sleep(delay)
+    retry_moves_later(partition)
+    return False
+
+
+def retry_moves_later(partition: int):
+    with retry_lock:
+        if partition in retry_scheduled:
+            return
+        retry_scheduled.add(partition)
+
+    def retry():
+        with retry_lock:
+            retry_scheduled.discard(partition)
+        with move_locks[partition]:
+            if not apply_recorded_moves(partition):
+                retry_moves_later(partition)
+
+    timer = threading.Timer(MOVE_RETRY_INTERVAL, retry)
+    timer.daemon = True
+    timer.start()
+
+
+# An item that is already in its new partition is left alone, the move
+# finished before and only the record was left behind. A failed move is
+# logged and the next one is still tried. Returns True if every move
+# finished.
+def apply_recorded_moves(partition: int) -> bool:
+    try:
+        with Session(engines[partition]) as session:
+            pending = session.exec(
+                select(moves.c.seq, moves.c.target, moves.c.item)
+            ).all()
+    except Exception:
+        logger.exception("Reading the moves out of partition %d failed", partition)
+        return False
+    finished = True
+    for seq, target, item in pending:
+        data = models.InventoryItems.model_validate_json(item).model_dump()
+        inserted = False
+        try:
+            with Session(engines[target]) as target_session:
+                target_session.exec(
+                    insert(models.Inventory).values(**data).on_conflict_do_nothing()
+                )
+                target_session.commit()
+            inserted = True
+            remember(data["id"], target)
+            unfinished_moves.discard(data["id"])
+            with Session(engines[partition]) as session:
+                session.exec(moves.delete().where(moves.c.seq == seq))
+                session.commit()
+        except Exception:
+            logger.exception(
+                "Moving item %s from partition %d to %d failed",
+                data["id"],
+                partition,
+                target,
+            )
+            if not inserted:
+                unfinished_moves.add(data["id"])
+            finished = False
+    return finished
+
+
+# Runs before the change feed publishes the moves (insert=True)
+@event.listens_for(Session, "after_commit", insert=True)
+def apply_committed_moves(session):
+    # Also called when a SAVEPOINT is released, only move on the real commit.
+    # Moves recorded in a SAVEPOINT that was rolled back were rolled back with
+    # it, apply_moves only sees committed ones.
+    if session.in_nested_transaction():
+        return
+    if session.info.pop("partition_moves", False):
+        apply_moves(partition_of(session))
+
+
+# Copy the items of the main database into their partitions, items that are
+# already there are skipped. Returns the number of items copied.
+def copy_into_partitions() -> int:
+    with Session(db_conn.engine) as source:
+        items = [
+            models.InventoryItems.model_validate(item)
+            for item in source.exec(select(models.Inventory)).all()
+        ]
+    copied = 0
+    for partition, engine in enumerate(engines):
+        with Session(engine) as session:
+            existing = set(session.exec(select(models.Inventory.id)).all())
+            for item in items:
+                if (
+                    partition_for(item.location) == partition
+                    and item.id not in existing
+                ):
+                    session.add(models.Inventory.model_validate(item.model_dump()))
+                    copied += 1
+            session.commit()
+    return copied
+
+
+if __name__ == "__main__":
+    if not PARTITIONED:
+        sys.exit("Set INVENTORY_PARTITIONS to the number of partitions first")
+    db_conn.create_db_and_tables()
+    create_db_and_tables()
+    copied = copy_into_partitions()
+    print(f"Copied {copied} items from {db_conn.sqlite_file_name}")
+    for partition in range(PARTITION_COUNT):
+        print(f"  {partition_file_name(partition)}")
@@ -0,0 +1,201 @@
+# Moves between partitions and the partition of each item id
+#
+# Items that change location move to another partition after the commit, a
+# failed write of the same group commit or a batch moving items the other way
+# must not lose or block them, and a move that cannot be inserted is reported
+# to its writer and retried until it arrives. Reads and writes by id go to the
+# item's partition only.
+#
+# pytest partitions_test.py
+# python partitions_test.py <scenario>   runs one scenario in this process
+from scenarios import (
+    group_commit,
+    locations_in_different_partitions,
+    new_item,
+    run_from_command_line,
+    run_scenario,
+)
+
+
+# A failed write rolls back its SAVEPOINT only, an item moved to another
+# partition by an earlier write of the batch still arrives there
+def failed_write_keeps_partition_moves():
+    import uuid
+    import partitions
+    from inventory_crud import (
+        InventoryNotFound,
+        create_inventory,
+        delete_inventory,
+        get_inventory,
+        run_write,
+        update_inventory,
+    )
+
+    partitions.create_db_and_tables()
+    source, target = locations_in_different_partitions()
+    item = run_write(create_inventory, new_item("a", source))
+    futures = group_commit(
+        partitions.partition_for(source),
+        (update_inventory, item.id, {"location": target}),
+        (delete_inventory, uuid.uuid4()),
+    )
+    assert isinstance(futures[1].exception(), InventoryNotFound)
+    assert futures[0].result().location == target
+    assert get_inventory(item.id).location == target
+
+
+# Batches moving items into each other's partitions at the same time both
+# commit, neither waits for the other's write lock while holding its own
+def opposite_moves_do_not_deadlock():
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    import partitions
+    from inventory_crud import (
+        create_inventory,
+        get_inventory,
+        run_write,
+        update_inventory,
+    )
+
+    partitions.create_db_and_tables()
+    first, second = locations_in_different_partitions()
+    a = run_write(create_inventory, new_item("a", first))
+    b = run_write(create_inventory, new_item("b", second))
+    # Both batches hold their write lock when they start committing
+    both_moved = threading.Barrier(2, timeout=10)
+
+    def wait_for_other_batch(session):
+        both_moved.wait()
+
+    def move(item, location):
+        return group_commit(
+            partitions.partition_for(item.location),
+            (update_inventory, item.id, {"location": location}),
+            (wait_for_other_batch,),
+        )
+
+    with ThreadPoolExecutor(2) as executor:
+        batches = list(executor.map(move, [a, b], [second, first]))
+    for futures in batches:
+        for future in futures:
+            assert future.exception() is None, future.exception()
+    assert get_inventory(a.id).location == second
+    assert get_inventory(b.id).location == first
+
+
+# Writes and reads by id go to the item's partition only, also after it
+# moved, and an out of date partition for an id does not hide the item
+def item_partition_is_remembered():
+    import partitions
+    from inventory_crud import (
+        create_inventory,
+        get_inventory,
+        run_write,
+        update_inventory,
+    )
+
+    partitions.create_db_and_tables()
+    source, target = locations_in_different_partitions()
+    item = run_write(create_inventory, new_item("a", source))
+
+    fan_out = partitions.fan_out
+    read = []
+
+    def recorded_fan_out(query, partition_ids=None):
+        read.append(
+            list(
+                range(partitions.PARTITION_COUNT)
+                if partition_ids is None
+                else partition_ids
+            )
+        )
+        return fan_out(query, partition_ids)
+
+    partitions.fan_out = recorded_fan_out
+    run_write(update_inventory, item.id, {"location": target})
+    assert get_inventory(item.id).location == target
+    assert get_inventory(item.id).location == target
+    assert all(len(partition_ids) == 1 for partition_ids in read), read
+
+    partitions.directory[item.id] = partitions.partition_for(source)
+    assert get_inventory(item.id).location == target
+    assert partitions.directory[item.id] == partitions.partition_for(target)
+
+
+# While the new partition refuses the item the write fails with
+# MoveIncomplete, the move stays recorded and arrives once the partition
+# takes it again
+def failed_move_is_reported_and_retried():
+    import time
+    from sqlmodel import Session, select
+    import partitions
+    from inventory_crud import (
+        MoveIncomplete,
+        create_inventory,
+        get_inventory,
+        run_write,
+        update_inventory,
+    )
+
+    partitions.MOVE_RETRY_DELAYS = (0.01,)
+    partitions.MOVE_RETRY_INTERVAL = 0.05
+    partitions.create_db_and_tables()
+    source, target = locations_in_different_partitions()
+    item = run_write(create_inventory, new_item("a", source))
+    target_engine = partitions.engines[partitions.partition_for(target)]
+    with target_engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE TRIGGER refuse_items BEFORE INSERT ON inventory "
+            "BEGIN SELECT RAISE(ABORT, 'refused'); END"
+        )
+
+    try:
+        run_write(update_inventory, item.id, {"location": target})
+    except MoveIncomplete:
+        pass
+    else:
+        raise AssertionError("the move was not reported")
+    assert get_inventory(item.id) is None
+    time.sleep(0.2)
+    assert item.id in partitions.unfinished_moves
+
+    with target_engine.begin() as connection:
+        connection.exec_driver_sql("DROP TRIGGER refuse_items")
+    deadline = time.monotonic() + 5
+    while item.id in partitions.unfinished_moves and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert get_inventory(item.id).location == target
+    with Session(partitions.engines[partitions.partition_for(source)]) as session:
+        assert session.exec(select(partitions.moves.c.seq)).all() == []
+
+
+SCENARIOS = {
+    "failed_write_keeps_partition_moves": failed_write_keeps_partition_moves,
+    "opposite_moves_do_not_deadlock": opposite_moves_do_not_deadlock,
+    "item_partition_is_remembered": item_partition_is_remembered,
+    "failed_move_is_reported_and_retried": failed_move_is_reported_and_retried,
+}
+
+
+def test_failed_write_keeps_partition_moves():
+    run_scenario(
+        __file__, "failed_write_keeps_partition_moves", INVENTORY_PARTITIONS="4"
+    )
+
+
+def test_opposite_moves_do_not_deadlock():
+    run_scenario(__file__, "opposite_moves_do_not_deadlock", INVENTORY_PARTITIONS="4")
+
+
+def test_item_partition_is_remembered():
+    run_scenario(__file__, "item_partition_is_remembered", INVENTORY_PARTITIONS="4")
+
+
+def test_failed_move_is_reported_and_retried():
+    run_scenario(
+        __file__, "failed_move_is_reported_and_retried", INVENTORY_PARTITIONS="4"
+    )
+
+
+if __name__ == "__main__":
+    run_from_command_line(SCENARIOS)
@@ -0,0 +1,246 @@
+# Query plan checks and index advisor for the inventory queries
+#
+# Runs the hot REST, UI and GraphQL requests against a seeded throwaway
+# database, records every SQL statement the app issues, and runs
+# EXPLAIN QUERY PLAN on each one. A statement that filters the inventory table
+# (has a WHERE clause) but still scans the whole table is a regression, and
+# an index for the columns it filters on is suggested.
+#
+# python query_plan_test.py   prints the plans and suggested indexes
+# pytest query_plan_test.py   fails if a hot query scans the table
+import os
+import re
+import sys
+from sample_inventory import seed_devices, use_throwaway_database
+
+use_throwaway_database("query-plan")
+# The plans of the SQL read paths are checked, not the in-memory replica
+os.environ["INVENTORY_READ_REPLICA"] = "0"
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+import db_conn
+from main import app
+
+SEED_DEVICES = 2000
+# Statements without a query plan worth checking
+SKIPPED_STATEMENTS = (
+    "PRAGMA",
+    "BEGIN",
+    "SAVEPOINT",
+    "RELEASE",
+    "ROLLBACK",
+    "CREATE",
+    "ANALYZE",
+    "INSERT",
+)
+
+ITEM_FIELDS = """
+    id name ipAddress location state deviceType make model osVersion endOfSupport
+"""
+
+
+def seed_database():
+    seed_devices(SEED_DEVICES)
+    with db_conn.engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+
+
+# A request that fails may not issue its queries at all, so every hot request
+# must succeed for the check to mean anything
+def check_response(response):
+    assert response.is_success, (
+        f"{response.request.method} {response.request.url} returned "
+        f"{response.status_code}: {response.text}"
+    )
+    return response
+
+
+def check_graphql(response):
+    errors = check_response(response).json().get("errors")
+    assert not errors, f"GraphQL errors: {errors}"
+    return response
+
+
+# The requests whose queries must stay indexed
+def run_hot_requests(client):
+    items = check_response(client.get("/inventory/api/")).json()
+    item_id = items[0]["id"]
+
+    check_response(client.get(f"/inventory/api/{item_id}"))
+    check_response(client.get("/inventory/api/", params={"limit": 50, "offset": 100}))
+    for params in [
+        {"location": "Site 1", "state": "ONLINE"},
+        {"location": "Site 1"},
+        {"make": "F5"},
+        {"name": "device-1.networkgear.net"},
+    ]:
+        check_response(client.get("/inventory/api/search", params=params))
+    end_of_support_window = {
+        "end_of_support_from": "2027-01-01",
+        "end_of_support_to": "2027-03-31",
+    }
+    check_response(client.get("/inventory/api/search", params=end_of_support_window))
+    for params in [{"make": "F5"}, end_of_support_window]:
+        check_response(client.get("/inventory/api/count", params=params))
+    created = check_response(
+        client.post(
+            "/inventory/api/",
+            json={
+                "name": "query-plan.networkgear.net",
+                "device_type": "Router",
+                "make": "F5",
+                "model": "r5900",
+            },
+        )
+    ).json()
+    check_response(
+        client.patch(f"/inventory/api/{created['id']}", json={"state": "OFFLINE"})
+    )
+    check_response(client.delete(f"/inventory/api/{created['id']}"))
+
+    check_response(client.get(f"/inventory/{item_id}/edit"))
+
+    for query, variables in [
+        (
+            f"query($id: UUID!) {{ inventoryItem(id: $id) {{ {ITEM_FIELDS} }} }}",
+            {"id": item_id},
+        ),
+        (
+            "query($location: String!) { inventoryByLocation(location: $location)"
+            f" {{ {ITEM_FIELDS} }} }}",
+            {"location": "Site 1"},
+        ),
+        (
+            f"query($make: String!) {{ inventoryByMake(make: $make) {{ {ITEM_FIELDS} }} }}",
+            {"make": "F5"},
+        ),
+    ]:
+        check_graphql(
+            client.post("/graphql", json={"query": query, "variables": variables})
+        )
+
+
+# Return (statement, parameters) for every SQL statement the hot requests issue
+def collect_statements():
+    statements = {}
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith(SKIPPED_STATEMENTS):
+            statements.setdefault(statement, parameters)
+
+    # db_conn reads INVENTORY_DB when it is first imported, if another module
+    # imported it before this one the app is on the real database
+    assert db_conn.sqlite_file_name == os.environ["INVENTORY_DB"], (
+        f"not seeding {db_conn.sqlite_file_name}, "
+        "run query_plan_test.py in its own pytest process"
+    )
+    event.listen(db_conn.engine, "before_cursor_execute", record)
+    try:
+        with TestClient(app) as client:
+            seed_database()
+            run_hot_requests(client)
+    finally:
+        event.remove(db_conn.engine, "before_cursor_execute", record)
+    return list(statements.items())
+
+
+def explain(statement, parameters):
+    with db_conn.engine.connect() as conn:
+        rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+    return [row[-1] for row in rows]
+
+
+def where_clause(statement) -> str | None:
+    where = re.split(r"\bWHERE\b", statement, maxsplit=1, flags=re.IGNORECASE)
+    return where[1] if len(where) == 2 else None
+
+
+# Columns compared in the WHERE clause (=, IN, IS, ranges, LIKE, ...), the
+# ones compared with = first, since an index can only use the columns after
+# a range condition to filter
+COMPARISON = re.compile(
+    r"inventory\.(\w+)\s*(=|!=|<>|<=|>=|<|>|NOT\s+IN\b|IN\b|IS\b|LIKE\b|BETWEEN\b)",
+    flags=re.IGNORECASE,
+)
+
+
+def filtered_columns(statement):
+    where = where_clause(statement)
+    if where is None:
+        return []
+    equality, other = [], []
+    for column, operator in COMPARISON.findall(where):
+        column = column.lower()
+        if column not in equality and column not in other:
+            (equality if operator == "=" else other).append(column)
+    return equality + other
+
+
+def suggest_index(columns):
+    if not columns:
+        return None
+    return (
+        f"CREATE INDEX ix_inventory_{'_'.join(columns)} "
+        f"ON inventory ({', '.join(columns)})"
+    )
+
+
+# Check every collected statement, returns a report entry per statement
+def check_query_plans():
+    report = []
+    for statement, parameters in collect_statements():
+        plan = explain(statement, parameters)
+        full_scan = any(re.match(r"SCAN inventory\b", step) for step in plan)
+        columns = filtered_columns(statement)
+        # A filtered statement that still reads the whole table, whatever
+        # the filter looks like
+        regression = full_scan and where_clause(statement) is not None
+        report.append(
+            {
+                "statement": " ".join(statement.split()),
+                "plan": plan,
+                "full_scan": full_scan,
+                "columns": columns,
+                "regression": regression,
+                "suggestion": suggest_index(columns) if regression else None,
+            }
+        )
+    return report
+
+
+# Drop suggestions that are a leftmost prefix of another suggested index,
+# an index on (location, state) also serves queries on location alone
+def merge_suggestions(column_lists):
+    merged = []
+    for columns in sorted(set(map(tuple, column_lists)), key=len, reverse=True):
+        if not any(other[: len(columns)] == columns for other in merged):
+            merged.append(columns)
+    return [suggest_index(columns) for columns in merged if columns]
+
+
+def test_hot_queries_use_indexes():
+    regressions = [entry for entry in check_query_plans() if entry["regression"]]
+    assert not regressions, "\n".join(
+        f"{entry['statement']}\n  {entry['plan']}\n  suggest: {entry['suggestion']}"
+        for entry in regressions
+    )
+
+
+if __name__ == "__main__":
+    report = check_query_plans()
+    for entry in report:
+        status = "SCAN" if entry["regression"] else "ok"
+        print(f"[{status}] {entry['statement']}")
+        for step in entry["plan"]:
+            print(f"    {step}")
+        if entry["suggestion"]:
+            print(f"    suggest: {entry['suggestion']}")
+    suggestions = merge_suggestions(
+        [entry["columns"] for entry in report if entry["regression"]]
+    )
+    if suggestions:
+        print("\nSuggested indexes:")
+        for suggestion in suggestions:
+            print(f"    {suggestion};")
+    sys.exit(1 if any(entry["regression"] for entry in report) else 0)
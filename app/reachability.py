@@ -0,0 +1,277 @@
+# Reachability poller
+#
+# Keeps the state column current: every INVENTORY_POLL_INTERVAL seconds each
+# device's ip_address is probed with a TCP connect to INVENTORY_POLL_PORTS.
+# A device is ONLINE if any port accepts the connection within
+# INVENTORY_POLL_TIMEOUT seconds, OFFLINE if every port refused, was
+# unreachable or timed out. A probe that failed because this host ran out of
+# sockets, file descriptors or buffers says nothing about the device, its
+# state is left as it is. Up to INVENTORY_POLL_CONCURRENCY probes run at the
+# same time on the event loop, fewer if the open file limit does not allow
+# one socket per port for each of them.
+#
+# Only state transitions are written, in batches of INVENTORY_POLL_BATCH_SIZE
+# items per UPDATE, so they go through the write coalescer and the change feed
+# like any other write. Devices without an ip_address are skipped. A batch
+# that cannot be written is logged and found again next cycle, the other
+# batches are still written.
+#
+# Enable with INVENTORY_POLLER=1, cycle metrics are served at
+# GET /reachability/metrics. INVENTORY_POLLER_FAKE_DEVICES=1 probes a
+# simulated network instead (fake_devices.py).
+import asyncio
+import collections
+import errno
+import logging
+import os
+import time
+from fastapi import APIRouter
+from sqlmodel import select
+import models
+import partitions
+from inventory_crud import run_write_on, set_inventory_state
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+POLLER_ENABLED = os.environ.get("INVENTORY_POLLER", "0") == "1"
+POLLER_FAKE_DEVICES = os.environ.get("INVENTORY_POLLER_FAKE_DEVICES", "0") == "1"
+POLL_INTERVAL = float(os.environ.get("INVENTORY_POLL_INTERVAL", "60"))
+POLL_PORTS = [
+    int(port) for port in os.environ.get("INVENTORY_POLL_PORTS", "22,443").split(",")
+]
+# Per device, covers all of its ports
+POLL_TIMEOUT = float(os.environ.get("INVENTORY_POLL_TIMEOUT", "2"))
+POLL_CONCURRENCY = int(os.environ.get("INVENTORY_POLL_CONCURRENCY", "1000"))
+POLL_BATCH_SIZE = int(os.environ.get("INVENTORY_POLL_BATCH_SIZE", "500"))
+
+ONLINE = "ONLINE"
+OFFLINE = "OFFLINE"
+
+# Connect errors caused by this host running out of file descriptors,
+# buffers, memory or local ports, they say nothing about the device. Other
+# errors (refused, unreachable, ...) mean the port cannot be reached.
+LOCAL_ERRNOS = {
+    errno.EMFILE,
+    errno.ENFILE,
+    errno.ENOBUFS,
+    errno.ENOMEM,
+    errno.EADDRNOTAVAIL,
+}
+
+logger = logging.getLogger(__name__)
+
+
+async def tcp_connect(host: str, port: int):
+    _, writer = await asyncio.open_connection(host, port)
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        # The port accepted the connection, that is all the probe needs
+        pass
+
+
+# True if any of the ports accepts a connection within timeout seconds, the
+# ports are tried at the same time. False if every port refused, was
+# unreachable or timed out, None if a port could not be probed because of a
+# local error.
+async def tcp_probe(host: str, ports: list[int], timeout: float) -> bool | None:
+    attempts = [asyncio.create_task(tcp_connect(host, port)) for port in ports]
+    local_error = False
+    try:
+        for attempt in asyncio.as_completed(attempts, timeout=timeout):
+            try:
+                await attempt
+                return True
+            except OSError as e:
+                # Refused, unreachable or the address does not resolve,
+                # unless the socket could not be opened here
+                if e.errno in LOCAL_ERRNOS:
+                    local_error = True
+                continue
+        return None if local_error else False
+    except asyncio.TimeoutError:
+        return None if local_error else False
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
+
+
+# Each tcp_probe holds a socket per port, leave a quarter of the open file
+# limit to the database and the clients
+def file_limited_concurrency(concurrency: int, ports: list[int]) -> int:
+    if resource is None:
+        return concurrency
+    limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if limit == resource.RLIM_INFINITY:
+        return concurrency
+    return max(1, min(concurrency, limit * 3 // 4 // len(ports)))
+
+
+# (partition, id, ip_address, state) of every device that has an address
+def load_devices() -> list[tuple]:
+    statement = select(
+        models.Inventory.id, models.Inventory.ip_address, models.Inventory.state
+    ).where(models.Inventory.ip_address.is_not(None), models.Inventory.ip_address != "")
+    results = partitions.fan_out(lambda session: session.exec(statement).all())
+    return [(partition, *row) for partition, rows in enumerate(results) for row in rows]
+
+
+class ReachabilityPoller:
+    def __init__(
+        self,
+        probe,
+        ports=POLL_PORTS,
+        timeout=POLL_TIMEOUT,
+        concurrency=POLL_CONCURRENCY,
+        batch_size=POLL_BATCH_SIZE,
+        interval=POLL_INTERVAL,
+    ):
+        # probe(host, ports, timeout) -> bool, or None if the device could
+        # not be probed
+        self.probe = probe
+        self.ports = ports
+        self.timeout = timeout
+        if probe is tcp_probe:
+            concurrency = file_limited_concurrency(concurrency, ports)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.interval = interval
+        self.task = None
+        self.cycles = 0
+        self.last_cycle = None
+        self.durations = collections.deque(maxlen=100)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            task, self.task = self.task, None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                await self.poll()
+            except Exception:
+                logger.exception("Reachability poll failed")
+            await asyncio.sleep(max(0, self.interval - (time.monotonic() - started)))
+
+    # Probe every device once and write back the state transitions
+    async def poll(self) -> dict:
+        started = time.monotonic()
+        devices = await asyncio.to_thread(load_devices)
+        loaded = time.monotonic()
+
+        # (partition, state) -> ids waiting to be written
+        pending = collections.defaultdict(list)
+        counts = collections.Counter()
+
+        async def write(partition, state, ids):
+            try:
+                changed = await asyncio.to_thread(
+                    run_write_on, partition, set_inventory_state, ids, state
+                )
+            except Exception:
+                # The devices keep their old state in the database, so the
+                # transition is found and written again next cycle
+                logger.exception("Writing %s for %d devices failed", state, len(ids))
+                counts["failed_batches"] += 1
+                return
+            counts["written"] += len(changed)
+            counts["batches"] += 1
+
+        # A fixed set of workers share one iterator, so 100k devices do not
+        # need 100k tasks
+        remaining = iter(devices)
+
+        async def worker():
+            for partition, inventory_id, ip_address, state in remaining:
+                reachable = await self.probe(ip_address, self.ports, self.timeout)
+                if reachable is None:
+                    counts["unknown"] += 1
+                    continue
+                new_state = ONLINE if reachable else OFFLINE
+                counts[new_state] += 1
+                if new_state == state:
+                    continue
+                counts["transitions"] += 1
+                batch = pending[(partition, new_state)]
+                batch.append(inventory_id)
+                if len(batch) >= self.batch_size:
+                    del pending[(partition, new_state)]
+                    await write(partition, new_state, batch)
+
+        # An unexpected error in one worker cancels the others instead of
+        # leaving them probing after the cycle failed
+        async with asyncio.TaskGroup() as workers:
+            for _ in range(min(self.concurrency, len(devices))):
+                workers.create_task(worker())
+        probed = time.monotonic()
+        for (partition, state), ids in list(pending.items()):
+            await write(partition, state, ids)
+
+        duration = time.monotonic() - started
+        self.cycles += 1
+        self.durations.append(duration)
+        self.last_cycle = {
+            "started_at": time.time() - duration,
+            "duration_seconds": round(duration, 3),
+            "load_seconds": round(loaded - started, 3),
+            "probe_seconds": round(probed - loaded, 3),
+            "devices": len(devices),
+            "probes_per_second": round(len(devices) / max(probed - loaded, 1e-9)),
+            "online": counts[ONLINE],
+            "offline": counts[OFFLINE],
+            "unknown": counts["unknown"],
+            "transitions": counts["transitions"],
+            "written": counts["written"],
+            "write_batches": counts["batches"],
+            "failed_write_batches": counts["failed_batches"],
+        }
+        return self.last_cycle
+
+    def metrics(self) -> dict:
+        durations = list(self.durations)
+        return {
+            "running": self.task is not None,
+            "interval": self.interval,
+            "ports": self.ports,
+            "timeout": self.timeout,
+            "concurrency": self.concurrency,
+            "cycles": self.cycles,
+            "cycle_duration_seconds": {
+                "last": durations[-1] if durations else None,
+                "avg": sum(durations) / len(durations) if durations else None,
+                "max": max(durations, default=None),
+            },
+            "last_cycle": self.last_cycle,
+        }
+
+
+def default_probe():
+    if POLLER_FAKE_DEVICES:
+        from fake_devices import FakeNetwork
+
+        return FakeNetwork().probe
+    return tcp_probe
+
+
+poller = ReachabilityPoller(default_probe())
+
+reachability_api = APIRouter()
+
+
+@reachability_api.get("/reachability/metrics", include_in_schema=False)
+def reachability_metrics():
+    return poller.metrics()
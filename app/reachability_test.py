@@ -0,0 +1,152 @@
+# Reachability poller
+#
+# Probes tell refused, unreachable and silent ports from connects that failed
+# because this host ran out of resources, which leave the device's state
+# alone. A write batch that fails does not stop the cycle.
+#
+# pytest reachability_test.py
+# python reachability_test.py <scenario>   runs one scenario in this process
+from scenarios import (
+    locations_in_different_partitions,
+    new_item,
+    run_from_command_line,
+    run_scenario,
+)
+
+
+# A poller write batch that fails does not stop the cycle, the batches of
+# the other partitions are written
+def poller_writes_past_failed_batch():
+    import asyncio
+    from sqlalchemy import event
+    from sqlmodel import Session
+    import partitions
+    from inventory_crud import count_inventory, create_inventory, run_write
+    from reachability import ReachabilityPoller
+
+    partitions.create_db_and_tables()
+    failing, working = locations_in_different_partitions()
+    for name, location in [("a", failing), ("b", working)]:
+        run_write(
+            create_inventory, {**new_item(name, location), "ip_address": "10.0.0.1"}
+        )
+
+    def fail(session):
+        if session.get_bind() is partitions.engines[partitions.partition_for(failing)]:
+            raise OSError("disk I/O error")
+
+    async def reachable(host, ports, timeout):
+        return True
+
+    event.listen(Session, "before_commit", fail)
+    cycle = asyncio.run(ReachabilityPoller(reachable).poll())
+    assert cycle["failed_write_batches"] == 1
+    assert cycle["written"] == 1
+    assert count_inventory({"state": "ONLINE"}) == 1
+    assert count_inventory({"state": "ONLINE", "location": working}) == 1
+
+
+# Refused, unresolvable and silent ports are down, a connect that failed for
+# lack of local sockets makes the probe inconclusive unless another port
+# answered, and the poller then keeps the device's state
+def local_errors_are_not_outages():
+    import asyncio
+    import errno
+    import socket
+    import partitions
+    import reachability
+    from inventory_crud import count_inventory, create_inventory, run_write
+    from reachability import ReachabilityPoller, tcp_probe
+
+    async def probe_real_ports():
+        server = await asyncio.start_server(lambda reader, writer: None, "127.0.0.1")
+        listening = server.sockets[0].getsockname()[1]
+        with socket.socket() as unused:
+            unused.bind(("127.0.0.1", 0))
+            closed = unused.getsockname()[1]
+        async with server:
+            return (
+                await tcp_probe("127.0.0.1", [closed, listening], 2),
+                await tcp_probe("127.0.0.1", [closed], 2),
+            )
+
+    assert asyncio.run(probe_real_ports()) == (True, False)
+
+    connect_errors = {
+        1: ConnectionRefusedError(errno.ECONNREFUSED, "refused"),
+        2: OSError(errno.EHOSTUNREACH, "unreachable"),
+        3: socket.gaierror(socket.EAI_NONAME, "unknown host"),
+        4: OSError(errno.EMFILE, "too many open files"),
+        5: OSError(errno.ENOBUFS, "no buffer space"),
+    }
+
+    async def connect(host, port):
+        if port == 6:
+            return
+        if port == 7:
+            await asyncio.sleep(10)
+        raise connect_errors[port]
+
+    reachability.tcp_connect = connect
+    for ports, reachable in [
+        ([1, 2, 3], False),
+        ([1, 7], False),
+        ([4], None),
+        ([1, 5], None),
+        ([4, 7], None),
+        ([4, 6], True),
+    ]:
+        assert asyncio.run(tcp_probe("10.0.0.1", ports, 0.05)) is reachable, ports
+
+    partitions.create_db_and_tables()
+    item = run_write(
+        create_inventory, {**new_item("a"), "ip_address": "10.0.0.1", "state": "ONLINE"}
+    )
+    cycle = asyncio.run(ReachabilityPoller(tcp_probe, ports=[4], timeout=0.05).poll())
+    assert (cycle["unknown"], cycle["transitions"]) == (1, 0)
+    assert count_inventory({"state": "ONLINE"}) == 1
+    cycle = asyncio.run(ReachabilityPoller(tcp_probe, ports=[1], timeout=0.05).poll())
+    assert (cycle["offline"], cycle["written"]) == (1, 1)
+    assert count_inventory({"state": "OFFLINE", "name": item.name}) == 1
+
+
+# A tcp_probe poller runs no more probes at a time than the open file limit
+# has sockets for, one per port
+def probe_concurrency_fits_file_limit():
+    import resource
+    from reachability import ReachabilityPoller, tcp_probe
+
+    resource.setrlimit(
+        resource.RLIMIT_NOFILE, (400, resource.getrlimit(resource.RLIMIT_NOFILE)[1])
+    )
+    assert (
+        ReachabilityPoller(tcp_probe, ports=[22, 443], concurrency=1000).concurrency
+        == 150
+    )
+    assert (
+        ReachabilityPoller(tcp_probe, ports=[22, 443], concurrency=100).concurrency
+        == 100
+    )
+
+
+SCENARIOS = {
+    "poller_writes_past_failed_batch": poller_writes_past_failed_batch,
+    "local_errors_are_not_outages": local_errors_are_not_outages,
+    "probe_concurrency_fits_file_limit": probe_concurrency_fits_file_limit,
+}
+
+
+def test_poller_writes_past_failed_batch():
+    run_scenario(__file__, "poller_writes_past_failed_batch", INVENTORY_PARTITIONS="4")
+
+
+def test_local_errors_are_not_outages():
+    run_scenario(__file__, "local_errors_are_not_outages")
+
+
+def test_probe_concurrency_fits_file_limit():
+    run_scenario(__file__, "probe_concurrency_fits_file_limit")
+
+
+if __name__ == "__main__":
+    run_from_command_line(SCENARIOS)
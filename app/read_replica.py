@@ -0,0 +1,356 @@
+# In-memory columnar read replica
+#
+# With INVENTORY_READ_REPLICA=1 the whole inventory is loaded into NumPy
+# columns at startup, and get_inventory, find_inventory and count_inventory in
+# inventory_crud read from it instead of SQLite. Filters are vectorised
+# comparisons over the columns, and paginated queries use a cached sort
+# order.
+#
+# Strings are dictionary encoded: each row has an int32 code and each
+# distinct value is kept once. Dates are datetime64 and IPv4 addresses are
+# uint32. Changes are written through: every change the write paths record
+# (change_feed.record_change) is applied when its transaction commits, before
+# the write returns, so clients read their own writes.
+#
+# numpy is optional, pip install numpy to enable the replica
+import ipaddress
+import os
+import threading
+import uuid
+from sqlmodel import select
+import models
+import partitions
+from change_feed import broadcaster
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+READ_REPLICA = os.environ.get("INVENTORY_READ_REPLICA", "0") == "1"
+
+STRING_COLUMNS = [
+    "name",
+    "location",
+    "state",
+    "device_type",
+    "make",
+    "model",
+    "os_version",
+]
+# ip_kind values
+NO_IP = 0
+IPV4 = 1
+OTHER_IP = 2  # hostnames, IPv6, anything that is not a plain IPv4 address
+# Deleted rows are dropped from the columns once they are this share of them
+COMPACT_RATIO = 0.25
+LOW_64_BITS = (1 << 64) - 1
+
+
+class DictionaryColumn:
+    def __init__(self, capacity: int):
+        # -1 means None
+        self.codes = numpy.full(capacity, -1, numpy.int32)
+        self.values = []
+        self.lookup = {}
+        self.rank = None
+
+    def encode(self, value) -> int:
+        if value is None:
+            return -1
+        code = self.lookup.get(value)
+        if code is None:
+            code = self.lookup[value] = len(self.values)
+            self.values.append(value)
+            self.rank = None
+        return code
+
+    # Position of each code's value in sorted order. The extra last entry is
+    # for code -1, None sorts first like NULL in SQLite.
+    def ranks(self):
+        if self.rank is None:
+            order = sorted(range(len(self.values)), key=self.values.__getitem__)
+            self.rank = numpy.empty(len(self.values) + 1, numpy.int64)
+            self.rank[order] = numpy.arange(len(self.values))
+            self.rank[-1] = -1
+        return self.rank
+
+
+class ColumnarInventory:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        # Changes that arrive while loading, replayed afterwards
+        self.pending = None
+
+    def reset(self, capacity: int):
+        self.size = 0
+        self.capacity = capacity
+        self.deleted_rows = 0
+        # id -> row
+        self.rows = {}
+        # Ids are never reused, late updates of deleted items are ignored
+        self.deleted_ids = set()
+        self.id_high = numpy.zeros(capacity, numpy.uint64)
+        self.id_low = numpy.zeros(capacity, numpy.uint64)
+        self.alive = numpy.zeros(capacity, bool)
+        self.version = numpy.zeros(capacity, numpy.int64)
+        self.end_of_support = numpy.full(capacity, numpy.datetime64("NaT"), "M8[D]")
+        self.ip_kind = numpy.zeros(capacity, numpy.int8)
+        self.ipv4 = numpy.zeros(capacity, numpy.uint32)
+        # row -> ip_address for OTHER_IP rows
+        self.other_ips = {}
+        self.strings = {column: DictionaryColumn(capacity) for column in STRING_COLUMNS}
+        # Rows sorted by name and id, None until needed after a change
+        self.order = None
+
+    # Load every partition, replaces whatever was loaded before
+    def load(self):
+        if numpy is None:
+            raise RuntimeError("INVENTORY_READ_REPLICA=1 needs numpy installed")
+        with self.lock:
+            self.pending = []
+        statement = select(*models.Inventory.__table__.columns)
+        results = partitions.fan_out(lambda session: session.exec(statement).all())
+        items = [
+            models.InventoryItems.model_construct(**row._mapping)
+            for rows in results
+            for row in rows
+        ]
+        with self.lock:
+            self.reset(max(1024, 2 * len(items)))
+            for item in items:
+                self.write_row(self.append_row(item.id), item)
+            for change in self.pending:
+                self.apply_change(change)
+            self.pending = None
+            self.loaded = True
+
+    # Write-through, called with every committed change
+    def apply(self, change):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append(change)
+            elif self.loaded:
+                self.apply_change(change)
+
+    def apply_change(self, change):
+        item = change.item
+        row = self.rows.get(item.id)
+        if change.op == "deleted":
+            self.deleted_ids.add(item.id)
+            if row is not None:
+                del self.rows[item.id]
+                self.alive[row] = False
+                self.deleted_rows += 1
+                if self.deleted_rows > COMPACT_RATIO * self.size:
+                    self.compact()
+        elif item.id in self.deleted_ids:
+            return
+        elif row is None:
+            self.write_row(self.append_row(item.id), item)
+        # Changes of one item can be published out of order by different
+        # threads, never go back to an older version
+        elif item.version >= self.version[row]:
+            self.write_row(row, item)
+
+    def append_row(self, inventory_id: uuid.UUID) -> int:
+        if self.size == self.capacity:
+            self.resize(2 * self.capacity)
+        row = self.size
+        self.size += 1
+        self.rows[inventory_id] = row
+        self.order = None
+        return row
+
+    def write_row(self, row: int, item):
+        name_code = self.strings["name"].codes[row]
+        for column, dictionary in self.strings.items():
+            dictionary.codes[row] = dictionary.encode(getattr(item, column))
+        if self.strings["name"].codes[row] != name_code:
+            self.order = None
+        self.id_high[row] = item.id.int >> 64
+        self.id_low[row] = item.id.int & LOW_64_BITS
+        self.alive[row] = True
+        self.version[row] = item.version
+        self.end_of_support[row] = (
+            numpy.datetime64(item.end_of_support, "D")
+            if item.end_of_support is not None
+            else numpy.datetime64("NaT")
+        )
+        self.other_ips.pop(row, None)
+        self.ip_kind[row] = NO_IP
+        if item.ip_address is not None:
+            try:
+                address = ipaddress.IPv4Address(item.ip_address)
+            except ValueError:
+                address = None
+            if address is not None and str(address) == item.ip_address:
+                self.ip_kind[row] = IPV4
+                self.ipv4[row] = int(address)
+            else:
+                self.ip_kind[row] = OTHER_IP
+                self.other_ips[row] = item.ip_address
+
+    def resize(self, capacity: int, keep=None):
+        # keep: rows to keep, in order, all of them by default
+        keep = numpy.arange(self.size) if keep is None else keep
+
+        def resized(array, fill):
+            new = numpy.full(capacity, fill, array.dtype)
+            new[: len(keep)] = array[keep]
+            return new
+
+        self.id_high = resized(self.id_high, 0)
+        self.id_low = resized(self.id_low, 0)
+        self.alive = resized(self.alive, False)
+        self.version = resized(self.version, 0)
+        self.end_of_support = resized(self.end_of_support, numpy.datetime64("NaT"))
+        self.ip_kind = resized(self.ip_kind, NO_IP)
+        self.ipv4 = resized(self.ipv4, 0)
+        for dictionary in self.strings.values():
+            dictionary.codes = resized(dictionary.codes, -1)
+        self.capacity = capacity
+
+    # Drop deleted rows, dictionaries keep their values
+    def compact(self):
+        keep = numpy.flatnonzero(self.alive[: self.size])
+        new_rows = {int(old): new for new, old in enumerate(keep)}
+        self.rows = {
+            inventory_id: new_rows[row] for inventory_id, row in self.rows.items()
+        }
+        self.other_ips = {
+            new_rows[row]: ip for row, ip in self.other_ips.items() if row in new_rows
+        }
+        self.resize(max(1024, 2 * len(keep)), keep)
+        self.size = len(keep)
+        self.deleted_rows = 0
+        self.order = None
+
+    # Rows sorted like ORDER BY name, id
+    def page_order(self):
+        if self.order is None:
+            name = self.strings["name"]
+            self.order = numpy.lexsort(
+                (
+                    self.id_low[: self.size],
+                    self.id_high[: self.size],
+                    name.ranks()[name.codes[: self.size]],
+                )
+            )
+        return self.order
+
+    def mask(self, filters: dict):
+        mask = self.alive[: self.size].copy()
+        for key, value in filters.items():
+            if key == "end_of_support_from":
+                mask &= self.end_of_support[: self.size] >= numpy.datetime64(value, "D")
+            elif key == "end_of_support_to":
+                mask &= self.end_of_support[: self.size] <= numpy.datetime64(value, "D")
+            else:
+                dictionary = self.strings[key]
+                code = dictionary.lookup.get(value)
+                if code is None:
+                    return numpy.zeros(self.size, bool)
+                mask &= dictionary.codes[: self.size] == code
+        return mask
+
+    # Copy the columns of rows, so the items can be built without the lock.
+    # Dictionaries only grow, their value lists can be shared.
+    def take(self, rows) -> dict:
+        return {
+            "id_high": self.id_high[rows],
+            "id_low": self.id_low[rows],
+            "version": self.version[rows],
+            "end_of_support": self.end_of_support[rows],
+            "ip_kind": self.ip_kind[rows],
+            "ipv4": self.ipv4[rows],
+            "other_ips": (
+                [self.other_ips.get(row) for row in rows.tolist()]
+                if self.other_ips
+                else [None] * len(rows)
+            ),
+            "strings": {
+                column: (dictionary.codes[rows], dictionary.values)
+                for column, dictionary in self.strings.items()
+            },
+        }
+
+    def items(self, columns: dict) -> list[models.InventoryItems]:
+        ids = columns["id_high"].astype(object) << 64 | columns["id_low"].astype(object)
+        strings = {
+            column: [values[code] if code >= 0 else None for code in codes.tolist()]
+            for column, (codes, values) in columns["strings"].items()
+        }
+        ip_addresses = [
+            (
+                str(ipaddress.IPv4Address(ipv4))
+                if kind == IPV4
+                else other if kind == OTHER_IP else None
+            )
+            for kind, ipv4, other in zip(
+                columns["ip_kind"].tolist(),
+                columns["ipv4"].tolist(),
+                columns["other_ips"],
+            )
+        ]
+        end_of_support = columns["end_of_support"].astype(object).tolist()
+        versions = columns["version"].tolist()
+        return [
+            models.InventoryItems.model_construct(
+                id=uuid.UUID(int=ids[i]),
+                version=versions[i],
+                ip_address=ip_addresses[i],
+                end_of_support=end_of_support[i],
+                **{column: values[i] for column, values in strings.items()},
+            )
+            for i in range(len(versions))
+        ]
+
+    def get(self, inventory_id: uuid.UUID) -> models.InventoryItems | None:
+        with self.lock:
+            row = self.rows.get(inventory_id)
+            if row is None:
+                return None
+            columns = self.take(numpy.array([row]))
+        return self.items(columns)[0]
+
+    # Same filters and page order as inventory_crud.find_inventory
+    def find(
+        self, filters: dict, limit: int | None = None, offset: int = 0
+    ) -> list[models.InventoryItems]:
+        with self.lock:
+            mask = self.mask(filters)
+            if limit is None:
+                rows = numpy.flatnonzero(mask)
+            else:
+                order = self.page_order()
+                rows = order[mask[order]][offset : offset + limit]
+            columns = self.take(rows)
+        return self.items(columns)
+
+    def count(self, filters: dict) -> int:
+        with self.lock:
+            return int(numpy.count_nonzero(self.mask(filters)))
+
+    def memory_usage(self) -> int:
+        arrays = [
+            self.id_high,
+            self.id_low,
+            self.alive,
+            self.version,
+            self.end_of_support,
+            self.ip_kind,
+            self.ipv4,
+        ] + [dictionary.codes for dictionary in self.strings.values()]
+        return sum(array.nbytes for array in arrays) + sum(
+            len(value)
+            for dictionary in self.strings.values()
+            for value in dictionary.values
+        )
+
+
+replica = ColumnarInventory()
+if READ_REPLICA:
+    broadcaster.add_listener(replica.apply)
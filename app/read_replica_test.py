@@ -0,0 +1,56 @@
+# Read replica consistency
+#
+# The replica applies the changes the write paths publish, so it must only see
+# committed ones.
+#
+# pytest read_replica_test.py
+# python read_replica_test.py <scenario>   runs one scenario in this process
+from scenarios import (
+    failing_commits,
+    group_commit,
+    new_item,
+    run_from_command_line,
+    run_scenario,
+)
+
+
+# The read replica only applies committed changes, a failed group commit
+# leaves it as it was and in step with the database
+def failed_commit_leaves_replica_unchanged():
+    from sqlmodel import Session, func, select
+    import models
+    import partitions
+    from inventory_crud import create_inventory, run_write, update_inventory
+    from read_replica import replica
+
+    partitions.create_db_and_tables()
+    item = run_write(create_inventory, new_item("a"))
+    replica.load()
+    with failing_commits():
+        futures = group_commit(
+            0,
+            (create_inventory, new_item("ghost")),
+            (update_inventory, item.id, {"state": "OFFLINE"}),
+        )
+    assert all(future.exception() is not None for future in futures)
+    assert replica.count({}) == 1
+    assert replica.get(item.id).state is None
+    assert replica.get(item.id).version == 1
+    with Session(partitions.engines[0]) as session:
+        stored = session.exec(select(func.count()).select_from(models.Inventory)).one()
+    assert stored == replica.count({})
+
+
+SCENARIOS = {
+    "failed_commit_leaves_replica_unchanged": failed_commit_leaves_replica_unchanged,
+}
+
+
+def test_failed_commit_leaves_replica_unchanged():
+    run_scenario(
+        __file__, "failed_commit_leaves_replica_unchanged", INVENTORY_READ_REPLICA="1"
+    )
+
+
+if __name__ == "__main__":
+    run_from_command_line(SCENARIOS)
@@ -0,0 +1,106 @@
+# Read latency of the SQL read paths and of the in-memory read replica
+#
+# Seeds a throwaway database, loads it into a read replica and prints the
+# median time of the same queries through inventory_crud (SQLite) and through
+# the replica, plus the replica's load time and memory use next to the size
+# of the database file. INVENTORY_PARTITIONS is honoured.
+#
+# python replica_benchmark.py [devices] [repeats]
+import os
+import statistics
+import sys
+import time
+from datetime import date
+from sample_inventory import seed_devices, use_throwaway_database
+
+
+# Median milliseconds of query() over repeats runs
+def median_ms(query, repeats: int) -> float:
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        query()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def benchmark(count: int, repeats: int):
+    import inventory_crud
+    import partitions
+    from read_replica import ColumnarInventory
+
+    partitions.create_db_and_tables()
+    seed_devices(count)
+    started = time.perf_counter()
+    replica = ColumnarInventory()
+    replica.load()
+    load_seconds = time.perf_counter() - started
+    some_id = inventory_crud.find_inventory(limit=1, offset=count // 2)[0].id
+
+    window = {
+        "end_of_support_from": date(2027, 1, 1),
+        "end_of_support_to": date(2027, 3, 31),
+    }
+    site = {"location": "Site 17", "state": "OFFLINE"}
+    queries = [
+        (
+            "count make=Cisco",
+            lambda: inventory_crud.count_inventory({"make": "Cisco"}),
+            lambda: replica.count({"make": "Cisco"}),
+        ),
+        (
+            "list make=Cisco",
+            lambda: inventory_crud.find_inventory({"make": "Cisco"}),
+            lambda: replica.find({"make": "Cisco"}),
+        ),
+        (
+            "list location+state",
+            lambda: inventory_crud.find_inventory(site),
+            lambda: replica.find(site),
+        ),
+        (
+            "count EOS window",
+            lambda: inventory_crud.count_inventory(window),
+            lambda: replica.count(window),
+        ),
+        (
+            "page 50 @1000",
+            lambda: inventory_crud.find_inventory(limit=50, offset=1000),
+            lambda: replica.find({}, 50, 1000),
+        ),
+        (
+            "get by id",
+            lambda: inventory_crud.get_inventory(some_id),
+            lambda: replica.get(some_id),
+        ),
+    ]
+
+    print(
+        f"{count} devices, {partitions.PARTITION_COUNT} partition(s), "
+        f"median of {repeats} runs"
+    )
+    print(f"{'query':<22}{'SQL ms':>10}{'replica ms':>12}{'speedup':>10}")
+    for name, sql_query, replica_query in queries:
+        sql_ms = median_ms(sql_query, repeats)
+        replica_ms = median_ms(replica_query, repeats)
+        print(
+            f"{name:<22}{sql_ms:>10.2f}{replica_ms:>12.3f}"
+            f"{sql_ms / replica_ms:>9.0f}x"
+        )
+
+    file_size = sum(
+        os.path.getsize(engine.url.database) for engine in partitions.engines
+    )
+    print(f"replica load {load_seconds:.2f}s")
+    print(
+        f"replica columns {replica.memory_usage() / 1e6:.1f} MB "
+        f"(capacity {replica.capacity} rows), "
+        f"database file {file_size / 1e6:.1f} MB"
+    )
+
+
+if __name__ == "__main__":
+    use_throwaway_database("replica-benchmark")
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    benchmark(count, repeats)
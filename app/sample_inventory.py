@@ -0,0 +1,62 @@
+# Generated inventory for the benchmarks and the query plan checks
+#
+# device(i) is the same device on every run, so results of different scripts
+# and runs are comparable. The scripts run on a throwaway database, see
+# use_throwaway_database().
+import os
+import tempfile
+from datetime import date, timedelta
+
+MAKES = [
+    ("Arista", "7050X"),
+    ("Cisco", "C9300"),
+    ("Juniper", "EX4300"),
+    ("F5", "BIG-IP i5800"),
+    ("Palo Alto", "PA-3220"),
+]
+STATES = ["ONLINE", "ONLINE", "ONLINE", "OFFLINE", "MAINTENANCE"]
+SITES = 200
+
+
+# Point the app at a new database in a temporary directory. Call it before
+# anything imports db_conn, which creates the engine from INVENTORY_DB then.
+def use_throwaway_database(prefix: str):
+    os.environ["INVENTORY_DB"] = os.path.join(
+        tempfile.mkdtemp(prefix=f"{prefix}-"), "inventory.db"
+    )
+
+
+# Device i has an address in 10.0.0.0/8 and is at one of SITES sites
+def device(i: int) -> dict:
+    make, model = MAKES[i % len(MAKES)]
+    return {
+        "name": f"device-{i}.networkgear.net",
+        "ip_address": f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}",
+        "location": f"Site {i % SITES}",
+        "state": STATES[i % 7 % len(STATES)],
+        "device_type": "Switch",
+        "make": make,
+        "model": model,
+        "os_version": f"{i % 9}.{i % 4}",
+        "end_of_support": date(2026, 1, 1) + timedelta(days=i * 7 % 2000),
+        "version": 1,
+    }
+
+
+# Insert devices 0 to count - 1 into the partitions of their locations, with
+# fields set on every one of them
+def seed_devices(count: int, **fields):
+    from sqlalchemy import insert
+    from sqlmodel import Session
+    import models
+    import partitions
+
+    rows = [[] for _ in partitions.engines]
+    for i in range(count):
+        row = {**device(i), **fields, "id": models.new_inventory_id()}
+        rows[partitions.partition_for(row["location"])].append(row)
+    for engine, partition_rows in zip(partitions.engines, rows):
+        if partition_rows:
+            with Session(engine) as session:
+                session.execute(insert(models.Inventory), partition_rows)
+                session.commit()
@@ -0,0 +1,106 @@
+# Test harness shared by the *_test.py files that run the app on its own
+# storage
+#
+# Every scenario runs in a fresh interpreter on a throwaway database, because
+# the storage settings (INVENTORY_PARTITIONS, INVENTORY_READ_REPLICA, ...) are
+# read when the app modules are first imported. A test file keeps its
+# scenarios in a SCENARIOS dict, runs them from its tests with
+# run_scenario(__file__, name, ...) and ends with
+#
+#   if __name__ == "__main__":
+#       run_from_command_line(SCENARIOS)
+#
+# so python <file>_test.py <scenario> runs one scenario in this process.
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+
+# Run a scenario of test_file in a new interpreter, environ is added to the
+# environment and INVENTORY_DB points at a new database unless it is given
+def run_scenario(test_file, name, **environ):
+    environ.setdefault(
+        "INVENTORY_DB",
+        os.path.join(tempfile.mkdtemp(prefix="scenario-"), "inventory.db"),
+    )
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(test_file), name],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={**os.environ, **environ},
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+
+
+def run_from_command_line(scenarios: dict):
+    scenarios[sys.argv[1]]()
+
+
+def new_item(name, location="Site 1") -> dict:
+    return {
+        "name": name,
+        "location": location,
+        "device_type": "Router",
+        "make": "F5",
+        "model": "r5900",
+    }
+
+
+# Two locations stored in different partitions
+def locations_in_different_partitions() -> tuple[str, str]:
+    import partitions
+
+    sites = (f"Site {i}" for i in itertools.count())
+    first = next(sites)
+    second = next(
+        site
+        for site in sites
+        if partitions.partition_for(site) != partitions.partition_for(first)
+    )
+    return first, second
+
+
+# Run writes ((write, *args) tuples) as one group commit on a partition and
+# return their futures
+def group_commit(partition, *writes) -> list[Future]:
+    from write_coalescer import coalescers
+
+    batch = [(write, args, Future()) for write, *args in writes]
+    coalescers[partition]._flush(batch)
+    return [future for _, _, future in batch]
+
+
+# Changes published while the block runs
+@contextmanager
+def published_changes():
+    from change_feed import broadcaster
+
+    changes = []
+    broadcaster.add_listener(changes.append)
+    try:
+        yield changes
+    finally:
+        broadcaster.listeners.remove(changes.append)
+
+
+# Make the next commits fail, like a full disk would
+@contextmanager
+def failing_commits():
+    import sqlite3
+    from sqlalchemy import event
+    from sqlmodel import Session
+
+    def fail(session):
+        if not session.in_nested_transaction():
+            raise sqlite3.OperationalError("disk I/O error")
+
+    event.listen(Session, "before_commit", fail)
+    try:
+        yield
+    finally:
+        event.remove(Session, "before_commit", fail)
@@ -0,0 +1,121 @@
+# Binary response formats for the inventory list endpoints
+#
+# Clients pick the format with the Accept header:
+#   application/msgpack                  MessagePack, same rows as the JSON
+#   application/vnd.apache.arrow.stream  Apache Arrow IPC stream, columnar
+#                                        (pandas/polars/duckdb load it directly)
+# Anything else gets the normal JSON response.
+#
+# msgpack and pyarrow are optional, pip install msgpack pyarrow to enable them
+import datetime
+from fastapi import HTTPException, Request, Response
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+# Documents the extra formats in the OpenAPI schema
+LIST_RESPONSES = {
+    200: {
+        "content": {
+            MSGPACK_MEDIA_TYPE: {},
+            ARROW_MEDIA_TYPE: {},
+        }
+    }
+}
+
+STRING_COLUMNS = ["name", "ip_address", "os_version"]
+# Few distinct values, dictionary encoded in Arrow
+CATEGORY_COLUMNS = ["location", "state", "device_type", "make", "model"]
+
+
+def encode_msgpack_value(value):
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value)
+
+
+def msgpack_body(items) -> bytes:
+    rows = [item.model_dump() for item in items]
+    return msgpack.packb(rows, default=encode_msgpack_value)
+
+
+def arrow_body(items) -> bytes:
+    columns = {"id": pyarrow.array([str(item.id) for item in items], pyarrow.string())}
+    for column in STRING_COLUMNS:
+        columns[column] = pyarrow.array(
+            [getattr(item, column) for item in items], pyarrow.string()
+        )
+    for column in CATEGORY_COLUMNS:
+        columns[column] = pyarrow.array(
+            [getattr(item, column) for item in items], pyarrow.string()
+        ).dictionary_encode()
+    columns["end_of_support"] = pyarrow.array(
+        [item.end_of_support for item in items], pyarrow.date32()
+    )
+    columns["version"] = pyarrow.array(
+        [item.version for item in items], pyarrow.int64()
+    )
+    table = pyarrow.table(columns)
+
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+# {value: q} of an Accept style header ("application/msgpack;q=0.5, */*"),
+# values are lower-cased and q defaults to 1
+def quality_values(header: str) -> dict[str, float]:
+    values = {}
+    for entry in header.split(","):
+        value, *params = [part.strip() for part in entry.split(";")]
+        if not value:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, param_value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = min(max(float(param_value), 0.0), 1.0)
+                except ValueError:
+                    quality = 0.0
+        values[value.lower()] = max(quality, values.get(value.lower(), 0.0))
+    return values
+
+
+# Return items in the format the client asked for, or the items themselves so
+# FastAPI serializes them to JSON with the route's response_model.
+# A binary format is only used when the client names it, with a q-value
+# above 0 and at least as high as the one JSON gets (directly or through
+# application/* or */*).
+def negotiate(request: Request, items):
+    accept = quality_values(request.headers.get("accept", ""))
+    json_quality = accept.get(
+        "application/json", accept.get("application/*", accept.get("*/*", 0))
+    )
+    quality = {
+        ARROW_MEDIA_TYPE: accept.get(ARROW_MEDIA_TYPE, 0),
+        MSGPACK_MEDIA_TYPE: accept.get(MSGPACK_MEDIA_TYPE, 0),
+    }
+    # Arrow wins a tie
+    media_type = max(quality, key=quality.get)
+    if quality[media_type] == 0 or quality[media_type] < json_quality:
+        return items
+    if media_type == ARROW_MEDIA_TYPE:
+        if pyarrow is None:
+            raise HTTPException(status_code=406, detail="Arrow support not installed")
+        return Response(content=arrow_body(items), media_type=ARROW_MEDIA_TYPE)
+    if msgpack is None:
+        raise HTTPException(status_code=406, detail="MessagePack support not installed")
+    return Response(content=msgpack_body(items), media_type=MSGPACK_MEDIA_TYPE)
@@ -0,0 +1,98 @@
+# Accept header negotiation of the list endpoints
+#
+# A binary format is only sent when the client names it with a q-value above
+# 0 and not below JSON's, and a format whose package is missing is a 406.
+#
+# pytest wire_formats_test.py
+import uuid
+from datetime import date
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+import models
+import wire_formats
+from wire_formats import ARROW_MEDIA_TYPE, MSGPACK_MEDIA_TYPE, negotiate
+
+ITEMS = [
+    models.InventoryItems(
+        id=uuid.uuid4(),
+        version=1,
+        name="a",
+        location="Site 1",
+        device_type="Router",
+        make="F5",
+        model="r5900",
+        end_of_support=date(2027, 1, 1),
+    )
+]
+
+
+def request(accept: str) -> Request:
+    return Request(
+        {"type": "http", "headers": [(b"accept", accept.encode())] if accept else []}
+    )
+
+
+# Media type of the response negotiate() picks, JSON when it returns the items
+def negotiated(accept: str) -> str:
+    response = negotiate(request(accept), ITEMS)
+    return "application/json" if response is ITEMS else response.media_type
+
+
+@pytest.mark.parametrize(
+    "accept, media_type",
+    [
+        ("", "application/json"),
+        ("*/*", "application/json"),
+        ("application/json", "application/json"),
+        (MSGPACK_MEDIA_TYPE, MSGPACK_MEDIA_TYPE),
+        (f"{MSGPACK_MEDIA_TYPE};q=0", "application/json"),
+        (f"{MSGPACK_MEDIA_TYPE};q=0, */*", "application/json"),
+        (f"{MSGPACK_MEDIA_TYPE};q=0.5, application/json", "application/json"),
+        (f"application/json;q=0.5, {MSGPACK_MEDIA_TYPE}", MSGPACK_MEDIA_TYPE),
+        (f"{MSGPACK_MEDIA_TYPE}, */*;q=0.1", MSGPACK_MEDIA_TYPE),
+        (f"{MSGPACK_MEDIA_TYPE}, {ARROW_MEDIA_TYPE}", ARROW_MEDIA_TYPE),
+        (f"{MSGPACK_MEDIA_TYPE}, {ARROW_MEDIA_TYPE};q=0.9", MSGPACK_MEDIA_TYPE),
+        (f"{ARROW_MEDIA_TYPE};q=0", "application/json"),
+    ],
+)
+def test_negotiate(accept, media_type):
+    if media_type == MSGPACK_MEDIA_TYPE:
+        pytest.importorskip("msgpack")
+    if media_type == ARROW_MEDIA_TYPE:
+        pytest.importorskip("pyarrow")
+    assert negotiated(accept) == media_type
+
+
+def test_msgpack_body():
+    msgpack = pytest.importorskip("msgpack")
+    response = negotiate(request(MSGPACK_MEDIA_TYPE), ITEMS)
+    assert msgpack.unpackb(response.body) == [
+        {
+            **ITEMS[0].model_dump(),
+            "id": str(ITEMS[0].id),
+            "end_of_support": "2027-01-01",
+        }
+    ]
+
+
+def test_arrow_body():
+    pyarrow = pytest.importorskip("pyarrow")
+    response = negotiate(request(ARROW_MEDIA_TYPE), ITEMS)
+    table = pyarrow.ipc.open_stream(response.body).read_all()
+    assert table.column("id").to_pylist() == [str(ITEMS[0].id)]
+    assert table.column("end_of_support").to_pylist() == [date(2027, 1, 1)]
+
+
+# A format the client asked for but the server cannot produce is a 406, a
+# refused one falls back to JSON
+@pytest.mark.parametrize(
+    "module, media_type",
+    [("msgpack", MSGPACK_MEDIA_TYPE), ("pyarrow", ARROW_MEDIA_TYPE)],
+)
+def test_missing_format_package(monkeypatch, module, media_type):
+    monkeypatch.setattr(wire_formats, module, None)
+    with pytest.raises(HTTPException) as raised:
+        negotiate(request(media_type), ITEMS)
+    assert raised.value.status_code == 406
+    assert negotiated(f"{media_type};q=0, application/json") == "application/json"
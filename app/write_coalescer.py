@@ -0,0 +1,135 @@
+# Group commit for concurrent single-item writes
+#
+# SQLite syncs to disk once per commit, so when many clients write at the same
+# time throughput is capped by one fsync per request. When enabled the write
+# coalescer queues writes and runs them in one transaction every few
+# milliseconds (or every N writes). Each write runs in its own SAVEPOINT, so a
+# write that fails is rolled back on its own and its caller gets its own
+# error, while the rest of the batch is committed together.
+#
+# With partitioned storage every partition has its own coalescer.
+#
+# Enable with INVENTORY_WRITE_COALESCING=1
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from sqlmodel import Session
+import partitions
+
+WRITE_COALESCING = os.environ.get("INVENTORY_WRITE_COALESCING", "0") == "1"
+# Flush when this many writes are queued
+WRITE_BATCH_SIZE = int(os.environ.get("INVENTORY_WRITE_BATCH_SIZE", "100"))
+# or when the oldest queued write has waited this long
+WRITE_BATCH_DELAY_MS = float(os.environ.get("INVENTORY_WRITE_BATCH_DELAY_MS", "2"))
+
+logger = logging.getLogger(__name__)
+
+
+class WriteCoalescer:
+    def __init__(self, engine, batch_size=100, batch_delay_ms=2.0):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay_ms / 1000
+        self.queue = queue.Queue()
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._run, name="write-coalescer", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        # Writes queued before stop() are still flushed
+        if self.thread is not None:
+            thread, self.thread = self.thread, None
+            self.queue.put(None)
+            thread.join()
+
+    # Queue write(session, *args) for the next group commit
+    # The returned future resolves to the write's result after the commit
+    def submit(self, write, *args) -> Future:
+        future = Future()
+        self.queue.put((write, args, future))
+        return future
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.batch_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                self._flush(batch)
+            except Exception as e:
+                # Keep the thread alive, the callers of this batch get the error
+                logger.exception("Write batch failed")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _flush(self, batch):
+        # Writes whose caller cancelled them before they ran are skipped, the
+        # rest can no longer be cancelled
+        batch = [
+            (write, args, future)
+            for write, args, future in batch
+            if future.set_running_or_notify_cancel()
+        ]
+        if not batch:
+            return
+        results = []
+        try:
+            with Session(self.engine) as session:
+                # Start the transaction ourselves, the sqlite3 driver would
+                # otherwise only start it at the first write and the first
+                # RELEASE SAVEPOINT would commit it. IMMEDIATE takes the write
+                # lock up front so the batch cannot fail on lock upgrade.
+                session.connection().exec_driver_sql("BEGIN IMMEDIATE")
+                for write, args, future in batch:
+                    try:
+                        with session.begin_nested():
+                            results.append((future, write(session, *args), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+                session.commit()
+        except Exception as e:
+            # The commit failed, so none of the writes were saved
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+# One per partition, indexed like partitions.engines
+coalescers = [
+    WriteCoalescer(engine, WRITE_BATCH_SIZE, WRITE_BATCH_DELAY_MS)
+    for engine in partitions.engines
+]